@@ -0,0 +1,88 @@
+"""Benchmark the single pass segmenter against the previous chunk_text implementation
+
+    python benchmarks/chunker.py
+"""
+import re
+import string
+import time
+from typing import List, Optional
+
+from quebra_frases import sentence_tokenize
+
+from ovos_tts_plugin_piper.segmenter import TextChunks, TextSegmenter, segment_text
+
+TEXT = ("Dr. Smith arrived at 3.5 km from the station, e.g. near the bridge. "
+        "Was it late? It was: the train; the bus... everything | all of it! "
+        "Piper reads this text aloud, one clause at a time, as fast as it can. ") * 20
+
+
+def legacy_chunk_text(text: str, delimiters: Optional[List[str]] = None) -> TextChunks:
+    """chunk_text as it was before the segmenter, regexes built on every call"""
+    if not text:
+        return [('', '', True)]
+    results: TextChunks = []
+    delimiters = delimiters or [", ", ":", ";", "...", "|"]
+    delimiter_pattern = re.escape(delimiters[0])
+    for delimiter in delimiters[1:]:
+        delimiter_pattern += f"|{re.escape(delimiter)}"
+    for sentence in sentence_tokenize(text):
+        default_punc = sentence[-1] if sentence and sentence[-1] in string.punctuation else "."
+        parts = re.split(f'({delimiter_pattern})', sentence)
+        for i in range(0, len(parts), 2):
+            delimiter = parts[i + 1] if i + 1 < len(parts) else default_punc
+            is_last = (i + 2 >= len(parts))
+            results.append((parts[i].strip(), delimiter.strip(), is_last))
+    return results
+
+
+def legacy_remove_punctuation(text: str) -> str:
+    punctuation_pattern = r"[" + re.escape(string.punctuation) + r"]"
+    return re.sub(punctuation_pattern, '', text).strip()
+
+
+def bench(name, func, runs=200) -> float:
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    elapsed = (time.perf_counter() - start) / runs
+    print(f"{name:<40} {elapsed * 1000:8.3f} ms")
+    return elapsed
+
+
+def main():
+    assert segment_text(TEXT) == legacy_chunk_text(TEXT)
+    print(f"{len(TEXT)} chars, {len(legacy_chunk_text(TEXT))} clauses\n")
+
+    old = bench("legacy chunk_text", lambda: legacy_chunk_text(TEXT))
+    new = bench("segmenter", lambda: segment_text(TEXT))
+    print(f"speedup x{old / new:.1f}\n")
+
+    chunks = [c for c, _, _ in legacy_chunk_text(TEXT)]
+    old = bench("legacy remove_punctuation (all clauses)", lambda: [legacy_remove_punctuation(c) for c in chunks])
+    from ovos_tts_plugin_piper.espeak_wrapper import BasePhonemizer
+    new = bench("remove_punctuation (all clauses)", lambda: [BasePhonemizer.remove_punctuation(c) for c in chunks])
+    print(f"speedup x{old / new:.1f}\n")
+
+    # text arriving word by word, eg. from a streaming LLM
+    tokens = re.findall(r"\S+\s*", TEXT)
+
+    def rechunk_every_token():
+        # without incremental segmentation the whole text so far is chunked again for every token
+        text = ""
+        for token in tokens:
+            text += token
+            legacy_chunk_text(text)
+
+    def incremental():
+        segmenter = TextSegmenter()
+        for token in tokens:
+            segmenter.feed(token)
+        segmenter.flush()
+
+    old = bench(f"legacy, re-chunk per token ({len(tokens)})", rechunk_every_token, runs=5)
+    new = bench(f"incremental feed ({len(tokens)} tokens)", incremental, runs=5)
+    print(f"speedup x{old / new:.1f}")
+
+
+if __name__ == "__main__":
+    main()
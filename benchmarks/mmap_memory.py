@@ -0,0 +1,67 @@
+"""Memory of several processes holding the same voice, heap loading vs use_mmap
+
+    python benchmarks/mmap_memory.py --processes 3 --weights-mb 64
+
+every process loads the same model and waits, Pss (proportional set size, shared pages split
+between the processes mapping them) is read from all of them at the same time
+"""
+import argparse
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from synthetic_models import make_model, smaps_rollup_kb
+
+
+def child(model: str, use_mmap: bool):
+    from ovos_tts_plugin_piper.piper import PiperVoice
+    PiperVoice.load(model, use_mmap=use_mmap, warmup=True)
+    print("ready", flush=True)
+    sys.stdin.read()  # keep the model loaded until the parent is done measuring
+
+
+def measure(model: Path, processes: int, use_mmap: bool) -> list:
+    procs = [subprocess.Popen([sys.executable, __file__, "--child", str(model)] + (["--mmap"] if use_mmap else []),
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+             for _ in range(processes)]
+    try:
+        for proc in procs:
+            # skip log lines printed while loading
+            if not any(line.strip() == "ready" for line in iter(proc.stdout.readline, "")):
+                raise RuntimeError("benchmark process failed to load the model")
+        return [smaps_rollup_kb(proc.pid) for proc in procs]
+    finally:
+        for proc in procs:
+            proc.communicate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=3)
+    parser.add_argument("--weights-mb", type=int, default=64)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--mmap", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.mmap)
+        return
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        model = make_model(Path(model_dir) / "voice.onnx", args.weights_mb)
+        # convert once up front, the conversion is not part of what is measured
+        from ovos_tts_plugin_piper.piper import get_mmap_model
+        get_mmap_model(model)
+        print(f"{args.processes} processes, same {args.weights_mb}MB model\n")
+        for use_mmap in (False, True):
+            stats = measure(model, args.processes, use_mmap)
+            rss = sum(s["Rss"] for s in stats) / len(stats) / 1024
+            pss = sum(s["Pss"] for s in stats) / 1024
+            name = "use_mmap" if use_mmap else "heap loading"
+            print(f"{name:<14} Rss {rss:7.1f}MB per process  Pss {pss / len(stats):7.1f}MB per process  "
+                  f"{pss:7.1f}MB total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""First audio latency of a short interactive reply while long articles are being read
+
+    python benchmarks/scheduler_latency.py --articles 4
+
+compares running jobs to completion one after another with the scheduler, without and with priorities
+"""
+import argparse
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from synthetic_models import make_model
+
+from ovos_tts_plugin_piper.piper import PiperVoice
+from ovos_tts_plugin_piper.scheduler import Priority, SynthesisScheduler
+
+SENTENCE = "this is one sentence of a rather long article about nothing."
+REPLY = "timer set."
+
+
+def run_to_completion(engine: PiperVoice, article: str, trials: int) -> list:
+    """jobs hold the voice until they are done, the reply waits for the article"""
+    latencies = []
+    for _ in range(trials):
+        lock = threading.Lock()
+
+        def read_article():
+            with lock:
+                list(engine.synthesize_stream_raw(article))
+
+        reader = threading.Thread(target=read_article)
+        reader.start()
+        time.sleep(0.1)  # the article is being read when the reply arrives
+        start = time.monotonic()
+        with lock:
+            next(iter(engine.synthesize_stream_raw(REPLY)))
+        latencies.append(time.monotonic() - start)
+        reader.join()
+    return latencies
+
+
+def scheduled(engine: PiperVoice, article: str, articles: int, trials: int, use_priority: bool) -> list:
+    scheduler = SynthesisScheduler()
+    latencies = []
+    try:
+        for _ in range(trials):
+            jobs = [scheduler.submit(engine, article,
+                                     priority=Priority.LONG_FORM if use_priority else Priority.NORMAL)
+                    for _ in range(articles)]
+            time.sleep(0.1)
+            reply = scheduler.submit(engine, REPLY,
+                                     priority=Priority.INTERACTIVE if use_priority else Priority.NORMAL)
+            list(reply)
+            latencies.append(reply.metrics["first_audio"])
+            for job in jobs:
+                job.cancel()
+            for job in jobs:
+                job.wait()
+    finally:
+        scheduler.shutdown()
+    return latencies
+
+
+def report(name: str, latencies: list):
+    print(f"{name:<40} first audio median {statistics.median(latencies) * 1000:6.0f}ms "
+          f"max {max(latencies) * 1000:6.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--articles", type=int, default=4, help="long jobs running when the reply arrives")
+    parser.add_argument("--sentences", type=int, default=40, help="sentences per article")
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--weights-mb", type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        engine = PiperVoice.load(make_model(Path(model_dir) / "voice.onnx", args.weights_mb), warmup=True)
+    article = " ".join([SENTENCE] * args.sentences)
+    start = time.monotonic()
+    list(engine.synthesize_stream_raw(SENTENCE))
+    print(f"one sentence takes {(time.monotonic() - start) * 1000:.0f}ms, "
+          f"articles of {args.sentences} sentences\n")
+
+    report("run to completion, 1 article", run_to_completion(engine, article, args.trials))
+    report(f"scheduler, {args.articles} articles, no priority",
+           scheduled(engine, article, args.articles, args.trials, use_priority=False))
+    report(f"scheduler, {args.articles} articles, priority",
+           scheduled(engine, article, args.articles, args.trials, use_priority=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Check the segmenter against the previous chunk_text implementation on random text
+
+    python benchmarks/segmenter_fuzz.py --runs 20000
+
+- batch segmentation gives the same chunks as the legacy quebra_frases based chunk_text
+- feeding the same text in random pieces gives the same chunks as segmenting it at once
+- texts ending in a zero width sentence boundary (。！？ in Chinese and Japanese) end without an empty
+  sentence, and no clause keeps its punctuation once punctuation is removed
+
+exits with status 1 on the first mismatches
+"""
+import argparse
+import random
+import sys
+from typing import List
+
+from chunker import legacy_chunk_text
+
+from ovos_tts_plugin_piper.espeak_wrapper import BasePhonemizer
+from ovos_tts_plugin_piper.segmenter import TextChunks, TextSegmenter, get_segmenter_rules, segment_text
+
+ALPHABET = list("abc XYZ.?!,:;|...\n\t'\"") + [", ", "... ", "Dr. ", "e.g. ", "3.5 ", "  ", "?!", ".)"]
+CJK_ALPHABET = list("你好再见。！？，、；： ab.") + ["。 ", "？\n"]
+
+
+def random_text(rng: random.Random, alphabet: List[str]) -> str:
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 25)))
+
+
+def incremental(text: str, lang: str, rng: random.Random) -> TextChunks:
+    segmenter = TextSegmenter(get_segmenter_rules(lang))
+    chunks: TextChunks = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 4)
+        chunks += segmenter.feed(text[pos:pos + size])
+        pos += size
+    return chunks + segmenter.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = []
+    for _ in range(args.runs):
+        text = random_text(rng, ALPHABET)
+        expected = legacy_chunk_text(text)
+        if segment_text(text) != expected:
+            failures.append(("legacy", text, expected, segment_text(text)))
+        if incremental(text, "en-us", rng) != expected:
+            failures.append(("incremental", text, expected, incremental(text, "en-us", rng)))
+
+        for lang in ("cmn", "ja"):
+            text = random_text(rng, CJK_ALPHABET)
+            chunks = segment_text(text, lang)
+            if incremental(text, lang, rng) != chunks:
+                failures.append((f"incremental {lang}", text, chunks, incremental(text, lang, rng)))
+            # ". " keeps the legacy empty last sentence, only zero width boundaries must not leave one
+            if text.rstrip()[-1:] in ("。", "！", "？") and not chunks[-1][0]:
+                failures.append((f"empty last sentence {lang}", text, None, chunks))
+            clauses = [BasePhonemizer.remove_punctuation(chunk, lang) for chunk, _, _ in chunks]
+            rules = get_segmenter_rules(lang)
+            if any(char in rules.punctuation for clause in clauses for char in clause):
+                failures.append((f"punctuation left {lang}", text, None, clauses))
+
+    for check, text, expected, got in failures[:8]:
+        print(f"{check}: {text!r}\n  expected {expected}\n  got      {got}")
+    print(f"{args.runs} runs, {len(failures)} mismatches")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Threads and RSS of loaded voices, per session onnxruntime threads vs the shared environment
+
+    python benchmarks/shared_environment.py --voices 5 --threads 4
+
+every configuration runs in a fresh process, the global thread pools can not be undone
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from synthetic_models import make_model, proc_status
+
+
+def load_voices(model_dir: Path, voices: int, threads: int, shared: bool, same_model: bool) -> dict:
+    import onnxruntime
+    from ovos_tts_plugin_piper.piper import PiperConfig, PiperVoice, SharedEnvironment
+
+    if shared:
+        SharedEnvironment.enable(threads, 1)
+    engines = []
+    for i in range(voices):
+        model = model_dir / f"voice{0 if same_model else i}.onnx"
+        if shared:
+            engines.append(PiperVoice.load(model, warmup=True))
+            continue
+        # what every session did before the shared environment, its own intra op pool
+        sess_options = SharedEnvironment.session_options(shared=False)
+        sess_options.intra_op_num_threads = threads
+        with open(f"{model}.json") as f:
+            config = PiperConfig.from_dict(json.load(f))
+        engine = PiperVoice(config=config,
+                            session=onnxruntime.InferenceSession(str(model), sess_options=sess_options,
+                                                                 providers=["CPUExecutionProvider"]))
+        engine.warmup()
+        engines.append(engine)
+    status = proc_status()
+    return {"threads": int(status["Threads"]), "rss_mb": int(status["VmRSS"].split()[0]) / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voices", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=4, help="intra op threads")
+    parser.add_argument("--weights-mb", type=int, default=16)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        model_dir, shared, same_model = json.loads(args.child)
+        print(json.dumps(load_voices(Path(model_dir), args.voices, args.threads, shared, same_model)))
+        return
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        for i in range(args.voices):
+            make_model(Path(model_dir) / f"voice{i}.onnx", args.weights_mb, seed=i)
+        print(f"{args.voices} voices of {args.weights_mb}MB, {args.threads} intra op threads\n")
+        for same_model in (False, True):
+            for shared in (False, True):
+                child = json.dumps([model_dir, shared, same_model])
+                out = subprocess.run([sys.executable, __file__, "--voices", str(args.voices),
+                                      "--threads", str(args.threads), "--child", child],
+                                     capture_output=True, text=True, check=True).stdout
+                result = json.loads(out.strip().splitlines()[-1])
+                models = "same model" if same_model else "different models"
+                env = "shared environment" if shared else "per session threads"
+                print(f"{models:<18} {env:<22} threads {result['threads']:>3}  RSS {result['rss_mb']:7.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
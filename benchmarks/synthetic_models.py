@@ -0,0 +1,72 @@
+"""Synthetic piper shaped models for the benchmarks, no voice download needed
+
+the model takes the piper inputs (input, input_lengths, scales) and runs them through one
+weight matrix of the requested size, enough to measure memory and threads of loaded sessions.
+Needs the optional `onnx` package.
+"""
+import json
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+PHONEMES = "abcdefghijklmnopqrstuvwxyz "
+
+
+def make_model(model_path: Union[str, Path], weights_mb: int = 16, seed: int = 0) -> Path:
+    """write <model_path> and <model_path>.json, returns the model path"""
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    model_path = Path(model_path)
+    model_path.parent.mkdir(parents=True, exist_ok=True)
+    size = int((weights_mb * 2 ** 20 / 4) ** 0.5)
+    weights = np.random.default_rng(seed).random((size, size), dtype=np.float32)
+
+    def const(name, values):
+        return helper.make_node("Constant", [], [name],
+                                value=helper.make_tensor(name, TensorProto.INT64, [len(values)], values))
+
+    nodes = [
+        const("column_shape", [-1, 1]),
+        const("repeats", [1, size]),
+        const("axes", [0, 1]),
+        helper.make_node("Cast", ["input"], ["ids"], to=TensorProto.FLOAT),
+        helper.make_node("Reshape", ["ids", "column_shape"], ["column"]),
+        helper.make_node("Tile", ["column", "repeats"], ["x"]),
+        helper.make_node("MatMul", ["x", "W"], ["y"]),
+        helper.make_node("Flatten", ["y"], ["audio"], axis=0),
+        helper.make_node("Unsqueeze", ["audio", "axes"], ["output"]),
+    ]
+    graph = helper.make_graph(
+        nodes, "synthetic_piper",
+        [helper.make_tensor_value_info("input", TensorProto.INT64, [1, "phonemes"]),
+         helper.make_tensor_value_info("input_lengths", TensorProto.INT64, [1]),
+         helper.make_tensor_value_info("scales", TensorProto.FLOAT, [3])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, 1, 1, "samples"])],
+        initializer=[numpy_helper.from_array(weights, "W")])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, str(model_path))
+
+    config = {"num_symbols": len(PHONEMES) + 3, "num_speakers": 1,
+              "audio": {"sample_rate": 22050},
+              "espeak": {"voice": "en-us"},
+              "phoneme_type": "text",
+              "phoneme_id_map": {"_": [0], "^": [1], "$": [2],
+                                 **{c: [3 + i] for i, c in enumerate(PHONEMES)}}}
+    with open(f"{model_path}.json", "w") as f:
+        json.dump(config, f)
+    return model_path
+
+
+def proc_status(pid: Union[int, str] = "self") -> dict:
+    """/proc/<pid>/status fields, eg. Threads and VmRSS"""
+    with open(f"/proc/{pid}/status") as f:
+        return {k: v.strip() for k, v in (line.split(":", 1) for line in f)}
+
+
+def smaps_rollup_kb(pid: Union[int, str] = "self") -> dict:
+    """/proc/<pid>/smaps_rollup fields in kB, eg. Rss and Pss"""
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        return {k: int(v.split()[0]) for k, v in (line.split(":", 1) for line in f if ":" in line)}
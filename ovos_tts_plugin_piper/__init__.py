@@ -10,52 +10,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import json
-import onnxruntime
+import os
+import threading
+import time
 import wave
-from langcodes import closest_supported_match
 from ovos_plugin_manager.templates.tts import TTS
-from ovos_tts_plugin_piper.piper import PiperVoice, PiperConfig
+from ovos_tts_plugin_piper.adaptive import QualityRouter
+from ovos_tts_plugin_piper.cancel import CancelToken, SynthesisCancelled, CANCELLED_WORK
+from ovos_tts_plugin_piper.espeak_wrapper import EspeakPhonemizer, get_espeak_voice
+from ovos_tts_plugin_piper.lexicon import load_lexicons
+from ovos_tts_plugin_piper.piper import PiperVoice, SharedEnvironment, get_model_config_path
+from ovos_tts_plugin_piper.streaming import StreamingSession
 from ovos_tts_plugin_piper.voice_models import add_local_model, LOCALMODELS, LANG2VOICES, SHORTNAMES, \
-    VoiceNotFoundError, get_voice_files, get_default_voice
+    VoiceNotFoundError, get_voice_files, get_default_voice, standardize_lang, get_faster_voices, get_voice_tier
 from ovos_utils import classproperty
-from ovos_utils.lang import standardize_lang_tag
 from ovos_utils.log import LOG
 
 
-def get_espeak_voice(lang: str) -> str:
-    _ESPEAK_VOICES = {'es-419', 'ca', 'qya', 'ga', 'en-us-nyc', 'et', 'ky', 'io', 'fa-latn', 'en-gb', 'fo', 'haw', 'kl',
-                      'ta', 'ml', 'gd', 'sd', 'es', 'hy', 'ur', 'ro', 'hi', 'or', 'ti', 'ca-va', 'om', 'tr', 'pa',
-                      'smj', 'mk', 'bg', 'cv', "fr", 'fi', 'en-gb-x-rp', 'ru', 'mt', 'an', 'mr', 'pap', 'vi', 'id',
-                      'chr-US-Qaaa-x-west', 'fr-be', 'ltg', 'my', 'nl', 'shn', 'ba', 'az', 'cmn', 'da', 'as', 'sw',
-                      'piqd', 'en-us', 'hr', 'it', 'ug', 'th', 'mi', 'cy', 'ru-lv', 'ia', 'tt', 'hu', 'xex', 'te', 'ne',
-                      'eu', 'ja', 'bpy', 'hak', 'cs', 'en-gb-scotland', 'hyw', 'uk', 'pt', 'bn', 'mto', 'yue',
-                      'be', 'gu', 'sv', 'sl', 'cmn-latn-pinyin', 'lfn', 'lv', 'fa', 'sjn', 'nog', 'ms',
-                      'vi-vn-x-central', 'lt', 'kn', 'he', 'qu', 'ca-ba', 'quc', 'nb', 'sk', 'tn', 'py', 'si', 'de',
-                      'ar', 'en-gb-x-gbcwmd', 'bs', 'qdb', 'sq', 'sr', 'tk', 'en-029', 'ht', 'ru-cl', 'af', 'pt-br',
-                      'fr-ch', 'ka', 'en-gb-x-gbclan', 'ko', 'is', 'ca-nw', 'gn', 'kok', 'la', 'lb', 'am', 'kk', 'ku',
-                      'kaa', 'jbo', 'eo', 'uz', 'nci', 'vi-vn-x-south', 'el', 'pl', 'grc'}
-    _INVALID = ['chr-US-Qaaa-x-west', 'en-us-nyc', 'fr-fr']  # fails to normalize
-
-    if lang.lower() == "en-gb":
-        return "en-gb-x-rp"
-    if lang in _ESPEAK_VOICES or lang in _INVALID:
-        return lang
-    if lang.lower().split("-")[0] in _ESPEAK_VOICES:
-        return lang.lower().split("-")[0]
-    voices = [v for v in _ESPEAK_VOICES if v not in _INVALID]
-    return closest_supported_match(lang, voices, 10)
-
-
 class PiperTTSPlugin(TTS):
     """Interface to Piper TTS."""
     engines = {}
 
     def __init__(self, config=None):
+        self._cancel_tokens = set()  # requests in progress, cancelled by stop()
+        self._sessions = set()  # open streaming sessions, cancelled by stop()
+        self._cancel_lock = threading.Lock()
         super().__init__(config=config)
         if self.config.get("model"):
             model = self.config["model"]
-            model_config = self.config.get("model_config") or model + ".json"
+            if model.startswith("http"):
+                model_config = self.config.get("model_config") or model + ".json"
+            else:
+                model_config = self.config.get("model_config") or str(get_model_config_path(model))
             add_local_model(voice=self.voice, model_path=model,
                             model_cfg=model_config, lang=self.lang)
 
@@ -71,16 +57,35 @@ class PiperTTSPlugin(TTS):
 
         self.accent = self.config.get("accent", None)
         self.use_cuda = self.config.get("use_cuda", False)
+        self.use_io_binding = self.config.get("use_io_binding", False)
+        self.warmup = self.config.get("warmup", True)  # avoid slow first inference after load
+        self.use_mmap = self.config.get("use_mmap", False)  # share model weights across processes
+        if self.config.get("shared_environment", False):
+            # global thread pools + shared allocator for all loaded voices
+            SharedEnvironment.enable(self.config.get("intra_op_num_threads", 0),
+                                     self.config.get("inter_op_num_threads", 0))
         self.noise_scale = self.config.get("noise-scale")  # generator noise
         self.length_scale = self.config.get("length-scale")  # Phoneme length
         self.noise_w = self.config.get("noise-w")  # Phoneme width noise
+        self.synth_timeout = self.config.get("synth_timeout")  # seconds, abandon synthesis after this
+        # user pronunciation lexicons, a directory of per-language files or a {lang: file} mapping
+        self.phonemizer = None
+        if self.config.get("lexicons"):
+            self.phonemizer = EspeakPhonemizer(lexicons=load_lexicons(self.config["lexicons"]))
+        # route to faster quality tiers under load
+        self.quality_router = None
+        adaptive_cfg = self.config.get("adaptive_quality")
+        if adaptive_cfg:
+            if not isinstance(adaptive_cfg, dict):
+                adaptive_cfg = {}  # "adaptive_quality": true
+            self.quality_router = QualityRouter.from_config(adaptive_cfg)
 
         # pre-load models
         preload_voices = self.config.get("preload_voices") or [self.voice]
         preload_langs = self.config.get("preload_langs") or []
 
         for lang in preload_langs:
-            lang = standardize_lang_tag(lang)
+            lang = standardize_lang(lang)
             voice = LANG2VOICES.get(lang)
             if voice and isinstance(voice, list):
                 voice = voice[0]
@@ -88,12 +93,18 @@ class PiperTTSPlugin(TTS):
                 preload_voices.append(voice)
 
         for voice in preload_voices:
-            self.lang2model(voice=voice)
-
-    def lang2model(self, lang=None, voice=None, speaker=None):
+            self.lang2model(voice=voice, preload=True)
+            if self.quality_router is not None and adaptive_cfg.get("preload_fallback", True):
+                # keep the next faster tier warm for bursts
+                fallback = [v for v in get_faster_voices(SHORTNAMES.get(voice) or voice)
+                            if get_voice_tier(v)[0] == get_voice_tier(voice)[0]]
+                if fallback:
+                    self.lang2model(voice=fallback[0], preload=True)
+
+    def lang2model(self, lang=None, voice=None, speaker=None, preload=False):
         # find default voice  (should be called model not voice....)
         if voice is None and lang is not None:
-            lang = standardize_lang_tag(lang)
+            lang = standardize_lang(lang)
             if lang == self.lang and LOCALMODELS:
                 voice = self.voice
             else:
@@ -120,6 +131,14 @@ class PiperTTSPlugin(TTS):
 
         voice = SHORTNAMES.get(voice) or voice  # normalize aliases
 
+        if self.quality_router is not None:
+            routed = self.quality_router.route(voice, PiperTTSPlugin.engines)
+            if routed != voice:
+                LOG.debug(f"Under load, routing '{voice}' to '{routed}'")
+                if get_voice_tier(routed)[0] != get_voice_tier(voice)[0]:
+                    speaker = 0  # different speaker family, speaker ids do not carry over
+                voice = routed
+
         # pre-loaded models
         if voice in PiperTTSPlugin.engines:
             return PiperTTSPlugin.engines[voice], speaker, voice
@@ -130,40 +149,34 @@ class PiperTTSPlugin(TTS):
             LOG.error(f"Voice files for '{voice}' not found: {e}")
             raise
 
-        return self.get_model(str(model), str(model_config), voice, speaker)
+        return self.get_model(str(model), str(model_config), voice, speaker, preload=preload)
 
     def get_model(self, model: str, model_config: str,
-                  voice: str = None, speaker=0):
+                  voice: str = None, speaker=0, preload=False):
         voice = voice or self.voice
-        with open(model_config, "r", encoding="utf-8") as config_file:
-            config_dict = json.load(config_file)
-
-        engine = PiperVoice(
-            config=PiperConfig.from_dict(config_dict),
-            session=onnxruntime.InferenceSession(
-                str(model),
-                sess_options=onnxruntime.SessionOptions(),
-                providers=["CPUExecutionProvider"]
-                if not self.use_cuda
-                else ["CUDAExecutionProvider"],
-            ),
-        )
-        LOG.debug(f"loaded model: {model}")
+        # warm-up only pays off ahead of requests, a request loading its voice would wait for it
+        engine = PiperVoice.load(model, model_config,
+                                 use_cuda=self.use_cuda,
+                                 use_io_binding=self.use_io_binding,
+                                 warmup=self.warmup and preload,
+                                 use_mmap=self.use_mmap)
+        if self.phonemizer is not None:
+            engine.phonemizer = self.phonemizer
+        LOG.debug(f"loaded model: {model} - {engine.metrics}")
         PiperTTSPlugin.engines[voice] = engine
         return engine, speaker, voice
 
-    def get_tts(self, sentence, wav_file, lang=None, voice=None, speaker=None):
-        """Generate WAV and phonemes.
+    def get_engine(self, lang=None, voice=None, speaker=None, preload=False):
+        """Select the engine for a request.
 
         Arguments:
-            sentence (str): sentence to generate audio for
-            wav_file (str): output file
             lang (str): optional lang override
             voice (str): optional voice override
             speaker (int): optional speaker override
+            preload (bool): the voice is loaded ahead of requests, warm it up if it is not loaded yet
 
         Returns:
-            tuple ((str) file location, (str) generated phonemes)
+            tuple ((PiperVoice) engine, (int) speaker, (str) voice, (str) phonemizer lang or None)
         """
         # HACK: bug in some neon-core versions
         # neon_audio.tts.neon:_get_tts:198 - INFO - Legacy Neon TTS signature found
@@ -173,12 +186,15 @@ class PiperTTSPlugin(TTS):
 
         phonemizer_lang = None  # if None use model's default accent
         if self.accent:
-            phonemizer_lang = get_espeak_voice(self.accent)
+            try:
+                phonemizer_lang = get_espeak_voice(self.accent)
+            except ValueError:
+                LOG.warning(f"espeak does not support accent '{self.accent}', using the voice's own accent")
 
         if voice:
             # user requested a specific voice model to be used
             lang = lang or self.lang
-            engine, speaker, voice = self.lang2model(lang, voice, speaker)
+            engine, speaker, voice = self.lang2model(lang, voice, speaker, preload=preload)
         elif lang:
             # requested a language but not a voice
             # - try to use default voice, but force language via phonemizer
@@ -187,27 +203,145 @@ class PiperTTSPlugin(TTS):
                 # force a specific espeak phonemizer to match lang pronunciation
                 # this allows a voice to speak a different language a bit better
                 phonemizer_lang = get_espeak_voice(lang)
-                engine, speaker, voice = self.lang2model(self.lang, self.voice)
+                engine, speaker, voice = self.lang2model(self.lang, self.voice, preload=preload)
             except:  # change to a voice that supports the lang
                 LOG.debug("Switching TTS model for one that supports target language")
-                engine, speaker, voice = self.lang2model(lang, voice, speaker)
+                engine, speaker, voice = self.lang2model(lang, voice, speaker, preload=preload)
         else:
             # default case, no specific voice or lang requested
-            engine, speaker, voice = self.lang2model(self.lang, self.voice)
+            engine, speaker, voice = self.lang2model(self.lang, self.voice, preload=preload)
 
         if phonemizer_lang:
             LOG.debug(f"Forcing Piper accent: {phonemizer_lang}")
+        return engine, speaker, voice, phonemizer_lang
 
-        with wave.open(wav_file, "wb") as f:
-            engine.synthesize(sentence, f,
-                              speaker_id=speaker,
-                              length_scale=self.length_scale,
-                              noise_scale=self.noise_scale,
-                              noise_w=self.noise_w,
-                              phonemizer_lang=phonemizer_lang)
+    def get_tts(self, sentence, wav_file, lang=None, voice=None, speaker=None, cancel_token=None,
+                input_mode=None):
+        """Generate WAV and phonemes.
+
+        Arguments:
+            sentence (str): sentence to generate audio for, text may contain inline [[ ipa ]] phonemes
+            wav_file (str): output file
+            lang (str): optional lang override
+            voice (str): optional voice override
+            speaker (int): optional speaker override
+            cancel_token (CancelToken): optional, synthesis stops at the next sentence once it is cancelled
+                or past its deadline, defaults to a token expiring after the configured synth_timeout
+            input_mode (str): "text" (default), "ipa" or "ids", for "ipa" sentence is an IPA string with
+                one sentence per line or a list of IPA sentences, for "ids" a list of phoneme id sequences
+                (a flat list of ids is a single sentence), pre-phonemized input skips espeak entirely
+
+        Returns:
+            tuple ((str) file location, (str) generated phonemes)
+
+        Raises:
+            SynthesisCancelled: if the request was cancelled, no partial audio file is left behind
+            ValueError: if pre-phonemized input is malformed or not supported by the voice
+        """
+        input_mode = input_mode or "text"
+        if input_mode not in ("text", "ipa", "ids"):
+            raise ValueError(f"unknown input_mode: {input_mode}")
+        if input_mode == "ipa" and isinstance(sentence, str):
+            sentence = [line.strip() for line in sentence.splitlines() if line.strip()]
+        if input_mode == "ids":
+            if sentence and all(isinstance(i, int) for i in sentence):
+                sentence = [sentence]  # a single sentence
+            elif isinstance(sentence, str) or not all(isinstance(ids, (list, tuple)) and
+                                                      all(isinstance(i, int) for i in ids) for ids in sentence):
+                raise ValueError("input_mode 'ids' takes a list of phoneme ids or a list of phoneme id sequences")
+        if cancel_token is None:
+            cancel_token = CancelToken(timeout=self.synth_timeout)
+        with self._cancel_lock:
+            self._cancel_tokens.add(cancel_token)
+        if self.quality_router is not None:
+            self.quality_router.request_started()
+        voice_served, start, audio_duration = None, None, 0.0
+        try:
+            engine, speaker, voice_served, phonemizer_lang = self.get_engine(lang, voice, speaker)
+            # model download/load/warm-up of a new voice is not synthesis time
+            start = time.monotonic()
+
+            with wave.open(wav_file, "wb") as f:
+                if input_mode == "text":
+                    engine.synthesize(sentence, f,
+                                      speaker_id=speaker,
+                                      length_scale=self.length_scale,
+                                      noise_scale=self.noise_scale,
+                                      noise_w=self.noise_w,
+                                      phonemizer_lang=phonemizer_lang,
+                                      cancel_token=cancel_token)
+                else:
+                    engine.synthesize_phonemes(sentence, f,
+                                               speaker_id=speaker,
+                                               length_scale=self.length_scale,
+                                               noise_scale=self.noise_scale,
+                                               noise_w=self.noise_w,
+                                               cancel_token=cancel_token)
+                audio_duration = f.getnframes() / engine.config.sample_rate
+        except Exception as e:
+            if isinstance(e, SynthesisCancelled):
+                LOG.debug(f"TTS cancelled, cancelled work so far: {dict(CANCELLED_WORK)}")
+            # truncated or empty audio must not be played or cached
+            if os.path.exists(wav_file):
+                os.remove(wav_file)
+            raise
+        finally:
+            with self._cancel_lock:
+                self._cancel_tokens.discard(cancel_token)
+            if self.quality_router is not None:
+                synth_time = time.monotonic() - start if start is not None else 0.0
+                self.quality_router.request_finished(voice_served, synth_time, audio_duration)
+        LOG.debug(f"TTS served by voice: {voice_served}")
 
         return wav_file, None
 
+    def stream_session(self, lang=None, voice=None, speaker=None, cancel_token=None) -> StreamingSession:
+        """Start a push based synthesis session for text that arrives in pieces, eg. from a LLM.
+
+        Feed text with session.feed(...), call session.close() at the end of the text
+        and iterate the session for 16-bit mono PCM at session.sample_rate, see StreamingSession.
+
+        Arguments:
+            lang (str): optional lang override
+            voice (str): optional voice override
+            speaker (int): optional speaker override
+            cancel_token (CancelToken): optional, synthesis stops at the next clause once it is cancelled,
+                stop() cancels open sessions
+
+        Returns:
+            StreamingSession: the session, synthesizing in a background thread
+        """
+        cancel_token = cancel_token or CancelToken()
+        engine, speaker, voice_served, phonemizer_lang = self.get_engine(lang, voice, speaker)
+
+        def on_finish(session: StreamingSession):
+            with self._cancel_lock:
+                self._sessions.discard(session)
+
+        session = StreamingSession(engine,
+                                   speaker_id=speaker,
+                                   length_scale=self.length_scale,
+                                   noise_scale=self.noise_scale,
+                                   noise_w=self.noise_w,
+                                   phonemizer_lang=phonemizer_lang,
+                                   cancel_token=cancel_token,
+                                   on_finish=on_finish)
+        with self._cancel_lock:
+            if not session.done:  # on_finish may already have run
+                self._sessions.add(session)
+        return session
+
+    def stop(self):
+        """Stops playback and abandons synthesis in progress at the next sentence."""
+        with self._cancel_lock:
+            for cancel_token in self._cancel_tokens:
+                cancel_token.cancel()
+            sessions = list(self._sessions)
+        # outside the lock, the session threads take it in on_finish
+        for session in sessions:
+            session.cancel()
+        super().stop()
+
     @classproperty
     def available_languages(cls) -> set:
         return set(LANG2VOICES.keys())
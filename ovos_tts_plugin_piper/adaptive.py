@@ -0,0 +1,84 @@
+"""Load aware selection of voice quality tiers
+
+Under load requests are routed to a faster quality tier (x_low, low, medium, high)
+of the same speaker family, or of the same language, and routed back once load drops.
+Load is the number of requests in flight plus a moving average of the real time factor
+(synthesis time / audio duration) of finished requests.
+"""
+import threading
+from collections import Counter
+from typing import Container, Dict, Optional
+
+from ovos_tts_plugin_piper.voice_models import get_faster_voices
+from ovos_utils.log import LOG
+
+
+class QualityRouter:
+    def __init__(self, max_queue_depth: int = 2,
+                 max_rtf: float = 0.8,
+                 recover_ratio: float = 0.5,
+                 smoothing: float = 0.3):
+        """
+        Args:
+            max_queue_depth: requests in flight above which faster tiers are used
+            max_rtf: real time factor above which faster tiers are used
+            recover_ratio: load must drop below threshold * recover_ratio before switching back
+            smoothing: weight of the latest measurement in the real time factor moving average
+        """
+        self.max_queue_depth = max_queue_depth
+        self.max_rtf = max_rtf
+        self.recover_ratio = recover_ratio
+        self.smoothing = smoothing
+        self.pending = 0
+        self.rtf = 0.0
+        self.degraded = False
+        self.served: Counter = Counter()
+        """voice -> number of requests served by it"""
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Dict) -> "QualityRouter":
+        return QualityRouter(max_queue_depth=config.get("max_queue_depth", 2),
+                             max_rtf=config.get("max_rtf", 0.8),
+                             recover_ratio=config.get("recover_ratio", 0.5),
+                             smoothing=config.get("smoothing", 0.3))
+
+    def request_started(self):
+        with self._lock:
+            self.pending += 1
+            self._update()
+
+    def request_finished(self, voice: Optional[str] = None,
+                         synth_time: float = 0.0, audio_duration: float = 0.0):
+        with self._lock:
+            self.pending = max(self.pending - 1, 0)
+            if audio_duration > 0:
+                rtf = synth_time / audio_duration
+                self.rtf = self.smoothing * rtf + (1 - self.smoothing) * self.rtf
+            if voice:
+                self.served[voice] += 1
+            self._update()
+
+    def _update(self):
+        overloaded = self.pending > self.max_queue_depth or self.rtf > self.max_rtf
+        recovered = (self.pending <= self.max_queue_depth * self.recover_ratio and
+                     self.rtf <= self.max_rtf * self.recover_ratio)
+        if not self.degraded and overloaded:
+            self.degraded = True
+            LOG.info(f"TTS under load (pending={self.pending}, rtf={self.rtf:.2f}), using faster voices")
+        elif self.degraded and recovered:
+            self.degraded = False
+            LOG.info(f"TTS load dropped (pending={self.pending}, rtf={self.rtf:.2f}), restoring requested voices")
+
+    def route(self, voice: str, loaded: Container[str] = ()) -> str:
+        """voice that should serve the next request, a faster tier while under load
+
+        only voices in `loaded` are used as faster tiers, loading a model under load would make it worse,
+        the requested voice is kept if no faster tier is loaded"""
+        if not self.degraded:
+            return voice
+        # nearest faster tier of the same family first, then of the language
+        for candidate in get_faster_voices(voice):
+            if candidate in loaded:
+                return candidate
+        return voice
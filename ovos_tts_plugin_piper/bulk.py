@@ -0,0 +1,256 @@
+"""Offline bulk pre-rendering of prompt catalogs
+
+    ovos-tts-piper-bulk prompts.tsv --output-dir ./prompts --lang en-US --voice alan-low
+
+Manifest formats, selected by file extension
+    .txt    one prompt per line
+    .tsv    id<TAB>text[<TAB>lang[<TAB>voice]]
+    .jsonl  {"id": ..., "text": ..., "lang": ..., "voice": ...} per line, only "text" is required
+
+Identical prompts (same text, lang and voice) are synthesized once, output files are named after a hash
+of everything that affects the audio, including the size and modification time of the voice files,
+so outputs are rendered again after a voice update. Finished prompts are appended to `index.jsonl`
+in the output dir, prompts whose output is already listed there and present on disk are skipped,
+so an interrupted run can simply be started again. Work is spread over one process per core, each with
+a single onnxruntime thread, prompts of the same voice are sent to the workers in batches so each process
+keeps the voice loaded.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from ovos_utils.log import LOG
+
+INDEX_FILE = "index.jsonl"
+
+
+@dataclass
+class Prompt:
+    text: str
+    id: Optional[str] = None
+    lang: Optional[str] = None
+    voice: Optional[str] = None
+
+    def key(self, config: Dict[str, Any], audio_format: str, model: Optional[List[Any]] = None) -> str:
+        """hash of everything that affects the rendered audio, model is the voice fingerprint"""
+        data = json.dumps([self.text, self.lang, self.voice, audio_format,
+                           sorted((k, str(v)) for k, v in config.items()), model],
+                          ensure_ascii=False)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def read_manifest(path: Union[str, Path]) -> List[Prompt]:
+    path = Path(path)
+    prompts: List[Prompt] = []
+    with open(path, encoding="utf-8") as f:
+        if path.suffix == ".jsonl":
+            for line in f:
+                if line.strip():
+                    data = json.loads(line)
+                    prompts.append(Prompt(text=data["text"], id=data.get("id"),
+                                          lang=data.get("lang"), voice=data.get("voice")))
+        elif path.suffix == ".tsv":
+            for row in csv.reader(f, delimiter="\t"):
+                if len(row) < 2 or not row[1].strip():
+                    continue
+                prompts.append(Prompt(id=row[0], text=row[1],
+                                      lang=row[2] if len(row) > 2 and row[2] else None,
+                                      voice=row[3] if len(row) > 3 and row[3] else None))
+        else:
+            prompts = [Prompt(text=line.strip()) for line in f if line.strip()]
+    return prompts
+
+
+def read_index(output_dir: Path) -> Dict[str, Dict[str, Any]]:
+    """key -> index entry, for outputs that still exist"""
+    index = {}
+    index_path = output_dir / INDEX_FILE
+    if index_path.exists():
+        with open(index_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partially written line of an interrupted run
+                if (output_dir / entry["file"]).exists():
+                    index[entry["key"]] = entry
+    return index
+
+
+def model_fingerprint(voice: str) -> List[Any]:
+    """[file, size, mtime] of every file of a voice"""
+    from ovos_tts_plugin_piper.piper import get_streaming_model_files
+    from ovos_tts_plugin_piper.voice_models import get_voice_files
+    model, model_config = get_voice_files(voice)
+    files = list(get_streaming_model_files(model) or [model]) + [model_config]
+    return [[str(f), f.stat().st_size, f.stat().st_mtime_ns] for f in map(Path, files)]
+
+
+# worker process state
+_PLUGIN = None
+
+
+def _init_worker(config: Dict[str, Any], threads: int):
+    global _PLUGIN
+    from ovos_tts_plugin_piper import PiperTTSPlugin
+    # every worker has its own sessions, the default of one intra op thread per core
+    # would start cores x workers threads fighting over the same cores
+    _PLUGIN = PiperTTSPlugin(dict(config, shared_environment=True,
+                                  intra_op_num_threads=threads, inter_op_num_threads=1))
+
+
+def _resolve_voice(lang: Optional[str], voice: Optional[str]) -> List[Any]:
+    """fingerprint of the voice serving prompts of lang/voice, the voice stays loaded in the worker"""
+    _, _, served_voice, _ = _PLUGIN.get_engine(lang, voice)
+    return model_fingerprint(served_voice)
+
+
+def _render_batch(items: List[Tuple[str, Prompt]], output_dir: str, audio_format: str) -> List[Tuple[str, str]]:
+    """synthesize a batch of prompts sharing lang/voice, returns [(key, file name)]"""
+    done = []
+    for key, prompt in items:
+        engine, speaker, _, phonemizer_lang = _PLUGIN.get_engine(prompt.lang, prompt.voice)
+        file_name = f"{key}.{audio_format}"
+        path = Path(output_dir) / file_name
+        tmp_path = path.with_name(path.name + ".tmp")
+        audio = b"".join(engine.synthesize_stream_raw(prompt.text,
+                                                      speaker_id=speaker,
+                                                      length_scale=_PLUGIN.length_scale,
+                                                      noise_scale=_PLUGIN.noise_scale,
+                                                      noise_w=_PLUGIN.noise_w,
+                                                      phonemizer_lang=phonemizer_lang))
+        if audio_format == "wav":
+            with wave.open(str(tmp_path), "wb") as f:
+                f.setframerate(engine.config.sample_rate)
+                f.setsampwidth(2)
+                f.setnchannels(1)
+                f.writeframes(audio)
+        else:
+            tmp_path.write_bytes(audio)
+        os.replace(tmp_path, path)
+        done.append((key, file_name))
+    return done
+
+
+def render(prompts: Iterable[Prompt], output_dir: Union[str, Path],
+           config: Optional[Dict[str, Any]] = None,
+           audio_format: str = "wav",
+           workers: Optional[int] = None,
+           batch_size: int = 16) -> Dict[str, Any]:
+    """Render prompts into output_dir, returns counters of the run
+
+    Args:
+        prompts: prompts to render
+        output_dir: directory for audio files and the index
+        config: plugin config, lang/voice are the defaults for prompts that do not set them
+        audio_format: "wav" or "raw" (16-bit mono PCM)
+        workers: number of worker processes, defaults to the number of cores,
+            onnxruntime threads of every worker are limited to cores / workers
+        batch_size: prompts sent to a worker at a time
+    """
+    config = config or {}
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    index = read_index(output_dir)
+    prompts = list(prompts)
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    entries: List[Dict[str, Any]] = []
+    stats = {"prompts": len(prompts), "unique": 0, "skipped": 0, "rendered": 0, "failed": 0}
+    rendered: Dict[str, str] = {key: entry["file"] for key, entry in index.items()}
+    if prompts:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(config, threads)) as pool, \
+                open(output_dir / INDEX_FILE, "a", encoding="utf-8") as index_file:
+            # the voice files are part of the key, resolve every lang/voice first
+            fingerprints: Dict[Tuple[Optional[str], Optional[str]], Any] = {}
+            futures = {pool.submit(_resolve_voice, lang, voice): (lang, voice)
+                       for lang, voice in {(p.lang, p.voice) for p in prompts}}
+            for future in as_completed(futures):
+                try:
+                    fingerprints[futures[future]] = future.result()
+                except Exception as e:
+                    LOG.error(f"Failed to load voice {futures[future]}: {e}")
+
+            # dedupe, many prompt ids may share one audio file
+            todo: Dict[str, Prompt] = {}
+            for prompt in prompts:
+                if (prompt.lang, prompt.voice) not in fingerprints:
+                    stats["failed"] += 1
+                    continue
+                key = prompt.key(config, audio_format, fingerprints[(prompt.lang, prompt.voice)])
+                entries.append({"id": prompt.id, "key": key, "text": prompt.text,
+                                "lang": prompt.lang, "voice": prompt.voice})
+                if key not in index:
+                    todo[key] = prompt
+            stats["unique"] = len({e["key"] for e in entries})
+            stats["skipped"] = stats["unique"] - len(todo)
+
+            # group by voice so a worker keeps its models warm
+            groups: Dict[Tuple[Optional[str], Optional[str]], List[Tuple[str, Prompt]]] = {}
+            for key, prompt in todo.items():
+                groups.setdefault((prompt.lang, prompt.voice), []).append((key, prompt))
+            batches = [items[i:i + batch_size]
+                       for items in groups.values()
+                       for i in range(0, len(items), batch_size)]
+
+            futures = {pool.submit(_render_batch, batch, str(output_dir), audio_format): batch
+                       for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    results = future.result()
+                except Exception as e:
+                    LOG.error(f"Failed to render batch: {e}")
+                    stats["failed"] += len(futures[future])
+                    continue
+                prompts_by_key = dict(futures[future])
+                for key, file_name in results:
+                    rendered[key] = file_name
+                    prompt = prompts_by_key[key]
+                    # flushed per entry, so an interrupted run can resume from here
+                    index_file.write(json.dumps({"key": key, "file": file_name, "text": prompt.text,
+                                                 "lang": prompt.lang, "voice": prompt.voice},
+                                                ensure_ascii=False) + "\n")
+                    index_file.flush()
+                    stats["rendered"] += 1
+
+    # prompt id -> audio file
+    with open(output_dir / "prompts.json", "w", encoding="utf-8") as f:
+        json.dump({e["id"] or e["text"]: rendered[e["key"]]
+                   for e in entries if e["key"] in rendered},
+                  f, ensure_ascii=False, indent=2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bulk render prompts with piper")
+    parser.add_argument("manifest", help=".txt, .tsv or .jsonl file with the prompts")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--config", help="path to a json file with the plugin config")
+    parser.add_argument("--lang", default="en-US")
+    parser.add_argument("--voice", default="default")
+    parser.add_argument("--format", choices=["wav", "raw"], default="wav")
+    parser.add_argument("--workers", type=int, help="worker processes, defaults to the number of cores")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    config = {"lang": args.lang, "voice": args.voice}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config.update(json.load(f))
+
+    stats = render(read_manifest(args.manifest), args.output_dir, config,
+                   audio_format=args.format, workers=args.workers, batch_size=args.batch_size)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
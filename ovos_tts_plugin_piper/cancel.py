@@ -0,0 +1,71 @@
+"""Cooperative cancellation and deadlines for synthesis requests
+
+A CancelToken is checked at every text chunk (before each espeak call) and before every sentence
+is sent to the model, work stops at the next boundary once the token is cancelled or its deadline passes.
+"""
+import threading
+import time
+from collections import Counter
+from typing import Callable, List, Optional
+
+CANCELLED_WORK: Counter = Counter()
+"""counters of work that was not done, requests / deadlines_exceeded / chunks / sentences"""
+_STATS_LOCK = threading.Lock()
+
+
+class SynthesisCancelled(Exception):
+    """The request was cancelled or ran past its deadline"""
+
+
+class CancelToken:
+    def __init__(self, timeout: Optional[float] = None, deadline: Optional[float] = None):
+        """
+        Args:
+            timeout: seconds from now until the request is abandoned
+            deadline: absolute time.monotonic() value until the request is abandoned, takes precedence over timeout
+        """
+        if deadline is None and timeout is not None:
+            deadline = time.monotonic() + timeout
+        self.deadline = deadline
+        self._cancelled = threading.Event()
+        self._recorded = False
+        self._callbacks: List[Callable[[], None]] = []
+
+    def cancel(self):
+        self._cancelled.set()
+        for callback in list(self._callbacks):
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """call callback when the token is cancelled, eg. to wake up a thread waiting for work
+
+        called right away if the token is already cancelled, may be called more than once"""
+        self._callbacks.append(callback)
+        if self._cancelled.is_set():
+            callback()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or self.expired
+
+    def check(self, stage: str, skipped: int = 1):
+        """raise SynthesisCancelled if the request should stop
+
+        Args:
+            stage: kind of work being skipped, "chunks" or "sentences"
+            skipped: units of work left undone
+        """
+        if not self.cancelled:
+            return
+        with _STATS_LOCK:
+            CANCELLED_WORK[stage] += skipped
+            if not self._recorded:
+                self._recorded = True
+                CANCELLED_WORK["requests"] += 1
+                if not self._cancelled.is_set():
+                    CANCELLED_WORK["deadlines_exceeded"] += 1
+        raise SynthesisCancelled(f"synthesis cancelled, {skipped} {stage} skipped")
@@ -0,0 +1,526 @@
+"""Voice sharded routing over several piper servers
+
+No single host keeps every voice loaded, voices are assigned to worker nodes (ovos-tts-piper-server instances)
+by consistent hashing, every request is forwarded to the node that owns its voice, so the voice stays warm
+on one node instead of being loaded everywhere, and audio is streamed back as it is synthesized.
+
+When a node joins or leaves (or fails its health check) only the voices it owns move, the new owner is asked
+to load them before requests arrive and the previous owner, if still up, unloads them.
+
+    ovos-tts-piper-router --node 10.0.0.1:10200 --node 10.0.0.2:10200 --port 10200
+
+The router speaks the same protocol as the server, clients can not tell them apart.
+LocalCluster starts worker processes on this host to stand in for nodes, eg. for tests
+
+    with LocalCluster(3, config) as cluster:
+        router = ClusterRouter(cluster.nodes)
+        router.get_tts("hello world", "hello.wav", voice="alan-low")
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from ovos_tts_plugin_piper.espeak_wrapper import get_espeak_voice
+from ovos_tts_plugin_piper.server import PiperTTSServer
+from ovos_tts_plugin_piper.voice_models import SHORTNAMES, VoiceNotFoundError, get_default_voice
+from ovos_utils.log import LOG
+
+# (header, payload) of a protocol message, see server.py
+Event = Tuple[Dict[str, Any], bytes]
+
+
+def voice_key(lang: Optional[str] = None, voice: Optional[str] = None) -> str:
+    """routing key of a request, the voice the nodes will serve it with, see PiperTTSPlugin.get_engine
+
+    requests without a voice are spoken by the configured voice of the node with an espeak accent ("default"),
+    nodes only switch to the default voice of the language if espeak does not support it"""
+    if voice and voice != "default":
+        voice = voice.split("#")[0]  # speakers of a voice share its model
+        return SHORTNAMES.get(voice) or voice
+    if lang:
+        try:
+            get_espeak_voice(lang)
+            return "default"
+        except ValueError:
+            pass
+        try:
+            return get_default_voice(lang)
+        except VoiceNotFoundError:
+            return lang
+    return "default"
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 64):
+        """
+        Args:
+            nodes: node addresses
+            replicas: virtual points per node, more points spread voices more evenly
+        """
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        self.nodes: Set[str] = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            self._owners.pop(point, None)
+            idx = bisect.bisect_left(self._points, point)
+            if idx < len(self._points) and self._points[idx] == point:
+                self._points.pop(idx)
+
+    def get(self, key: str) -> Optional[str]:
+        """node owning key, None if the ring is empty"""
+        if not self._points:
+            return None
+        idx = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[idx]]
+
+
+class ClusterRouter:
+    def __init__(self, nodes: Iterable[str],
+                 replicas: int = 64,
+                 health_interval: float = 2.0,
+                 connect_timeout: float = 2.0,
+                 rebalance_timeout: float = 60.0):
+        """
+        Args:
+            nodes: "host:port" or "unix:///path" addresses of the piper servers
+            replicas: virtual points per node on the hash ring
+            health_interval: seconds between health checks of every node while serving
+            connect_timeout: seconds before a node that does not accept connections is considered down
+            rebalance_timeout: seconds a node gets to load a voice moved to it, requests do not wait for it
+        """
+        self.members: Set[str] = set(nodes)
+        self.ring = HashRing(self.members, replicas)
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self.rebalance_timeout = rebalance_timeout
+        self._rebalances: Set[asyncio.Task] = set()
+        self.known_voices: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        """voice key -> (lang, voice) of a request that used it, moved to the new owner on rebalance"""
+        self.node_voices: Dict[str, Dict[str, Set[str]]] = {}
+        """node -> key of PiperTTSPlugin.engines on the node, as reported by it -> voice keys it served"""
+
+    # membership
+    async def _open(self, node: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if node.startswith("unix://"):
+            connection = asyncio.open_unix_connection(node[len("unix://"):])
+        else:
+            host, port = node.rsplit(":", 1)
+            connection = asyncio.open_connection(host, int(port))
+        return await asyncio.wait_for(connection, self.connect_timeout)
+
+    async def _request(self, node: str, event_type: str, data: Optional[Dict[str, Any]] = None,
+                       timeout: Optional[float] = None) -> Optional[Event]:
+        """send one control event to a node and return its reply"""
+        reader, writer = await self._open(node)
+        try:
+            PiperTTSServer.write_event(writer, event_type, data)
+            await writer.drain()
+            return await asyncio.wait_for(PiperTTSServer.read_event(reader), timeout)
+        finally:
+            writer.close()
+
+    async def add_node(self, node: str):
+        """add a node to the ring, returns once the voices moved to it are loaded"""
+        self.members.add(node)
+        await self._wait_rebalance(self._change_ring(lambda: self.ring.add(node)))
+
+    async def remove_node(self, node: str, forget: bool = True):
+        """take a node out of the ring, forget=False keeps health checking it so it rejoins once it is back"""
+        if forget:
+            self.members.discard(node)
+            self.node_voices.pop(node, None)
+        await self._wait_rebalance(self._change_ring(lambda: self.ring.remove(node)))
+
+    def _change_ring(self, change) -> Optional[asyncio.Task]:
+        """apply a ring change right away, moved voices are loaded on their new owners in a background task"""
+        # no awaits between reading the old and the new owners, ring changes are atomic on the event loop
+        before = {key: self.ring.get(key) for key in self.known_voices}
+        change()
+        moved = {key: (old, self.ring.get(key)) for key, old in before.items() if self.ring.get(key) != old}
+        if not moved:
+            return None
+        LOG.info(f"piper router rebalance, nodes: {sorted(self.ring.nodes)}, moved voices: {moved}")
+        task = asyncio.create_task(self._rebalance(moved))
+        self._rebalances.add(task)
+        task.add_done_callback(self._rebalances.discard)
+        return task
+
+    @staticmethod
+    async def _wait_rebalance(task: Optional[asyncio.Task]):
+        if task is not None:
+            # shielded, a cancelled caller does not abort the rebalance for everyone else
+            await asyncio.shield(task)
+
+    async def _rebalance(self, moved: Dict[str, Tuple[Optional[str], Optional[str]]]):
+        await asyncio.gather(*(self._move(key, old, new) for key, (old, new) in moved.items()))
+
+    def _track(self, node: str, key: str, engine: str):
+        """node serves voice key with engine"""
+        self.node_voices.setdefault(node, {}).setdefault(engine, set()).add(key)
+
+    def _untrack(self, node: str, key: str) -> List[str]:
+        """forget that node serves voice key, returns the engines no other voice key of the node uses"""
+        engines = self.node_voices.get(node, {})
+        unused = []
+        for engine, keys in list(engines.items()):
+            keys.discard(key)
+            if not keys:
+                del engines[engine]
+                unused.append(engine)
+        return unused
+
+    async def _move(self, key: str, old: Optional[str], new: Optional[str]):
+        lang, voice = self.known_voices[key]
+        if new is not None:
+            try:
+                reply = await self._request(new, "load", {"lang": lang, "voice": voice},
+                                            timeout=self.rebalance_timeout)
+                if reply and reply[0].get("type") == "loaded":
+                    self._track(new, key, reply[0]["data"]["voice"])
+            except asyncio.TimeoutError:
+                LOG.warning(f"Timed out warming voice {key} on {new}, it will be loaded by its first request")
+            except Exception as e:
+                LOG.warning(f"Failed to warm voice {key} on {new}: {e}")
+        if old is None:
+            return
+        # several voice keys can be served by the same engine, eg. every request without a voice
+        # is spoken by the node's configured voice, it is only unloaded once none of them is left
+        for engine in self._untrack(old, key):
+            if old not in self.members:
+                break
+            try:
+                await self._request(old, "unload", {"voice": engine}, timeout=self.connect_timeout)
+            except Exception:
+                break  # old owner is down, nothing to free
+
+    async def check_health(self):
+        """describe every member, nodes that do not answer leave the ring and rejoin once they answer again"""
+
+        async def check(node: str):
+            try:
+                reply = await self._request(node, "describe", timeout=self.connect_timeout)
+                alive = reply is not None
+            except Exception:
+                alive = False
+            if alive and node not in self.ring.nodes:
+                LOG.info(f"piper node up: {node}")
+                await self._wait_rebalance(self._change_ring(lambda: self.ring.add(node)))
+            elif not alive and node in self.ring.nodes:
+                LOG.warning(f"piper node down: {node}")
+                await self.remove_node(node, forget=False)
+
+        await asyncio.gather(*(check(node) for node in list(self.members)))
+
+    # requests
+    async def stream(self, text: str, lang: Optional[str] = None, voice: Optional[str] = None,
+                     speaker: Optional[int] = None, priority: Optional[int] = None,
+                     timeout: Optional[float] = None) -> AsyncIterator[Event]:
+        """forward a synthesize request to the node owning its voice, yields the node's events as they arrive
+
+        nodes that can not be reached before any audio was sent are taken out of the ring
+        and the request is retried on the next owner right away, the rebalance runs in the background"""
+        key = voice_key(lang, voice)
+        self.known_voices.setdefault(key, (lang, voice))
+        data = {"text": text, "lang": lang, "voice": voice, "speaker": speaker,
+                "priority": priority, "timeout": timeout}
+        data = {k: v for k, v in data.items() if v is not None}
+        while True:
+            node = self.ring.get(key)
+            if node is None:
+                yield {"type": "error", "data": {"text": "no piper nodes available"}}, b""
+                return
+            try:
+                reader, writer = await self._open(node)
+            except (OSError, asyncio.TimeoutError):
+                LOG.warning(f"piper node unreachable: {node}")
+                self._change_ring(lambda: self.ring.remove(node))
+                continue
+            started = False
+            try:
+                PiperTTSServer.write_event(writer, "synthesize", data)
+                await writer.drain()
+                while True:
+                    event = await PiperTTSServer.read_event(reader)
+                    if event is None:
+                        raise ConnectionError(f"piper node closed the connection: {node}")
+                    started = True
+                    if event[0].get("type") == "audio-start" and event[0].get("data", {}).get("voice"):
+                        self._track(node, key, event[0]["data"]["voice"])
+                    yield event
+                    if event[0].get("type") in ("audio-stop", "error"):
+                        return
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                if started:
+                    yield {"type": "error", "data": {"text": str(e)}}, b""
+                    return
+                self._change_ring(lambda: self.ring.remove(node))
+            finally:
+                writer.close()
+
+    async def synthesize(self, text: str, lang: Optional[str] = None, voice: Optional[str] = None,
+                         speaker: Optional[int] = None) -> Tuple[int, bytes]:
+        """(sample rate, 16-bit mono PCM) of the whole text"""
+        rate, chunks = 22050, []
+        async for header, payload in self.stream(text, lang, voice, speaker):
+            if header.get("type") == "audio-start":
+                rate = header["data"]["rate"]
+            elif header.get("type") == "audio-chunk":
+                chunks.append(payload)
+            elif header.get("type") == "error":
+                raise RuntimeError(header["data"]["text"])
+        return rate, b"".join(chunks)
+
+    def get_tts(self, sentence: str, wav_file: str, lang: Optional[str] = None,
+                voice: Optional[str] = None, speaker: Optional[int] = None) -> Tuple[str, None]:
+        """PiperTTSPlugin.get_tts served by the cluster, for callers without an event loop"""
+        rate, audio = asyncio.run(self.synthesize(sentence, lang, voice, speaker))
+        with wave.open(wav_file, "wb") as f:
+            f.setframerate(rate)
+            f.setsampwidth(2)
+            f.setnchannels(1)
+            f.writeframes(audio)
+        return wav_file, None
+
+    # front server, same protocol as PiperTTSServer
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        forwarding: Set[asyncio.Task] = set()
+        previous: Optional[asyncio.Task] = None
+        try:
+            while True:
+                event = await PiperTTSServer.read_event(reader)
+                if event is None:
+                    break
+                header, _ = event
+                data = header.get("data") or {}
+                if header.get("type") == "synthesize":
+                    previous = asyncio.create_task(self._forward(data, writer, previous))
+                    forwarding.add(previous)
+                    previous.add_done_callback(forwarding.discard)
+                elif header.get("type") == "cancel":
+                    # closing the node connections cancels the requests on the nodes
+                    for task in forwarding:
+                        task.cancel()
+                elif header.get("type") == "describe":
+                    PiperTTSServer.write_event(writer, "info", await self.describe())
+                else:
+                    PiperTTSServer.write_event(writer, "error",
+                                               {"text": f"unknown event type: {header.get('type')}"})
+                await writer.drain()
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            LOG.exception(f"piper router client error: {e}")
+        finally:
+            for task in forwarding:
+                task.cancel()
+            writer.close()
+
+    async def _forward(self, data: Dict[str, Any], writer: asyncio.StreamWriter,
+                       previous: Optional[asyncio.Task]):
+        # keep responses of one connection in order, like the server does
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        stream = self.stream(data.get("text", ""), data.get("lang"), data.get("voice"),
+                             data.get("speaker"), data.get("priority"), data.get("timeout"))
+        try:
+            async for header, payload in stream:
+                PiperTTSServer.write_event(writer, header["type"], header.get("data"), payload)
+                await writer.drain()
+        except asyncio.CancelledError:
+            PiperTTSServer.write_event(writer, "audio-stop")
+        finally:
+            await stream.aclose()
+
+    async def describe(self) -> Dict[str, Any]:
+        nodes = {}
+        for node in sorted(self.members):
+            try:
+                reply = await self._request(node, "describe", timeout=self.connect_timeout)
+                nodes[node] = reply[0].get("data", {}) if reply else None
+            except Exception:
+                nodes[node] = None
+        languages = sorted({lang for info in nodes.values() if info for lang in info.get("languages", [])})
+        return {"languages": languages,
+                "loaded_voices": sorted({v for info in nodes.values() if info for v in info.get("loaded_voices", [])}),
+                "nodes": nodes,
+                "assignments": {key: self.ring.get(key) for key in self.known_voices}}
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                LOG.error(f"piper router health check failed: {e}")
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 10200, uri: Optional[str] = None):
+        """Serve forever on a TCP host/port, or on a unix socket if uri is set"""
+        await self.check_health()
+        if uri:
+            server = await asyncio.start_unix_server(self.handle_client, path=uri)
+            LOG.info(f"piper router listening on unix://{uri}")
+        else:
+            server = await asyncio.start_server(self.handle_client, host=host, port=port)
+            LOG.info(f"piper router listening on tcp://{host}:{port}")
+        health = asyncio.create_task(self._health_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            health.cancel()
+            for task in self._rebalances:
+                task.cancel()
+
+
+class LocalCluster:
+    def __init__(self, num_nodes: int = 3, config: Optional[Dict[str, Any]] = None,
+                 host: str = "127.0.0.1", ports: Optional[List[int]] = None,
+                 startup_timeout: float = 60.0):
+        """Worker processes on this host standing in for cluster nodes
+
+        Args:
+            num_nodes: number of piper servers to start
+            config: plugin config of every node
+            host: interface the nodes listen on
+            ports: node ports, free ports are picked if not given
+            startup_timeout: seconds to wait for a node to accept connections
+        """
+        self.config = config or {}
+        self.host = host
+        self.ports = ports or [self._free_port() for _ in range(num_nodes)]
+        self.startup_timeout = startup_timeout
+        self.processes: Dict[str, subprocess.Popen] = {}
+        self._config_file: Optional[str] = None
+
+    @property
+    def nodes(self) -> List[str]:
+        return [f"{self.host}:{port}" for port in self.ports]
+
+    def _free_port(self) -> int:
+        with socket.socket() as s:
+            s.bind((self.host, 0))
+            return s.getsockname()[1]
+
+    def start(self) -> "LocalCluster":
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(self.config, f)
+            self._config_file = f.name
+        for node in self.nodes:
+            self.start_node(node, wait=False)
+        for node in self.nodes:
+            self._wait_ready(node)
+        return self
+
+    def start_node(self, node: str, wait: bool = True):
+        port = node.rsplit(":", 1)[1]
+        self.processes[node] = subprocess.Popen([sys.executable, "-m", "ovos_tts_plugin_piper.server",
+                                                 "--host", self.host, "--port", port,
+                                                 "--config", self._config_file])
+        if wait:
+            self._wait_ready(node)
+
+    def _wait_ready(self, node: str):
+        deadline = time.monotonic() + self.startup_timeout
+        port = int(node.rsplit(":", 1)[1])
+        while time.monotonic() < deadline:
+            if self.processes[node].poll() is not None:
+                raise RuntimeError(f"piper node {node} exited with code {self.processes[node].returncode}")
+            try:
+                socket.create_connection((self.host, port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise TimeoutError(f"piper node {node} did not start")
+
+    def stop_node(self, node: str):
+        """terminate a node, eg. to simulate a failure"""
+        process = self.processes.pop(node, None)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    def stop(self):
+        for node in list(self.processes):
+            self.stop_node(node)
+        if self._config_file:
+            os.remove(self._config_file)
+            self._config_file = None
+
+    def __enter__(self) -> "LocalCluster":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="piper TTS router, shards voices over several piper servers")
+    parser.add_argument("--node", action="append", default=[],
+                        help="host:port or unix:///path of a piper server, repeat for every node")
+    parser.add_argument("--local-nodes", type=int, default=0,
+                        help="start this many piper servers on this host as nodes")
+    parser.add_argument("--config", help="path to a json file with the plugin config of local nodes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=10200)
+    parser.add_argument("--uri", help="unix socket path, used instead of host/port")
+    parser.add_argument("--health-interval", type=float, default=2.0)
+    parser.add_argument("--rebalance-timeout", type=float, default=60.0,
+                        help="seconds a node gets to load the voices moved to it")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+
+    cluster = LocalCluster(args.local_nodes, config).start() if args.local_nodes else None
+    nodes = args.node + (cluster.nodes if cluster else [])
+    if not nodes:
+        parser.error("no nodes, use --node and/or --local-nodes")
+    router = ClusterRouter(nodes, health_interval=args.health_interval,
+                           rebalance_timeout=args.rebalance_timeout)
+    try:
+        asyncio.run(router.serve(args.host, args.port, args.uri))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cluster is not None:
+            cluster.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,24 @@
 import abc
 import re
-import string
 import subprocess
 import unicodedata
 from enum import Enum
-from typing import List, Tuple, Optional, Literal
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Tuple, Optional, Literal, Sequence
 
 from langcodes import tag_distance
-from quebra_frases import sentence_tokenize
+from ovos_tts_plugin_piper.cancel import CancelToken
+from ovos_tts_plugin_piper.lexicon import Lexicon
+from ovos_tts_plugin_piper.segmenter import TextChunks, segment_text, remove_punctuation
+from ovos_utils.log import LOG
 
-# list of (substring, terminator, end_of_sentence) tuples.
-TextChunks = List[Tuple[str, str, bool]]
 # list of (phonemes, terminator, end_of_sentence) tuples.
 RawPhonemizedChunks = List[Tuple[str, str, bool]]
 
 PhonemizedChunks = list[list[str]]
 
+_LANG_SWITCH_FLAGS = re.compile(r"\([^)]+\)")
+
 
 class TextCasing(str, Enum):
     """Casing applied to text for phonemize_codepoints"""
@@ -27,6 +30,20 @@ class TextCasing(str, Enum):
 
 
 class BasePhonemizer(metaclass=abc.ABCMeta):
+    def __init__(self, lexicons: Optional[Dict[str, Lexicon]] = None):
+        """
+        Args:
+            lexicons: lang -> user pronunciation lexicon, words found there skip the phonemizer
+        """
+        self.lexicons: Dict[str, Lexicon] = {lang.lower(): lex for lang, lex in (lexicons or {}).items()}
+
+    def get_lexicon(self, lang: str) -> Optional[Lexicon]:
+        """lexicon for the exact lang, or else for its base language"""
+        if not self.lexicons:
+            return None
+        lang = lang.lower()
+        return self.lexicons.get(lang) or self.lexicons.get(lang.split("-")[0])
+
     @abc.abstractmethod
     def phonemize_string(self, text: str, lang: str) -> str:
         raise NotImplementedError
@@ -34,14 +51,52 @@ class BasePhonemizer(metaclass=abc.ABCMeta):
     def phonemize_to_list(self, text: str, lang: str) -> List[str]:
         return list(self.phonemize_string(text, lang))
 
-    def phonemize(self, text: str, lang: str) -> PhonemizedChunks:
+    def phonemize_segments(self, segments: List[str], lang: str) -> List[str]:
+        """phonemize several independent pieces of text, one phoneme string per piece"""
+        return [self.phonemize_string(segment, lang) for segment in segments]
+
+    def phonemize(self, text: str, lang: str, cancel_token: Optional[CancelToken] = None,
+                  preprocess: Optional[Callable[[str], str]] = None) -> PhonemizedChunks:
+        """
+        Args:
+            text: text to phonemize
+            lang: phonemizer language
+            cancel_token: checked before every chunk
+            preprocess: text stage applied to each chunk before phonemization, eg. diacritization
+        """
         if not text:
             return [('', '', True)]
-        results: RawPhonemizedChunks = []
-        for chunk, punct, eos in self.chunk_text(text):
-            phoneme_str = self.phonemize_string(self.remove_punctuation(chunk), lang)
-            results += [(phoneme_str, punct, True)]
-        return self._process_phones(results)
+        return list(self.iter_phonemize(text, lang, cancel_token, preprocess))
+
+    def iter_phonemize(self, text: str, lang: str, cancel_token: Optional[CancelToken] = None,
+                       preprocess: Optional[Callable[[str], str]] = None) -> Iterator[List[str]]:
+        """like phonemize, but every sentence is yielded as soon as it is phonemized,
+        the rest of the text is only preprocessed and phonemized when the next sentence is requested"""
+        if not text:
+            yield []
+            return
+        lexicon = self.get_lexicon(lang)
+        chunks = self.chunk_text(text, lang=lang)
+        for idx, (chunk, punct, eos) in enumerate(chunks):
+            if cancel_token is not None:
+                cancel_token.check("chunks", len(chunks) - idx)
+            if preprocess is not None:
+                chunk = preprocess(chunk)
+            if lexicon is None:
+                phoneme_str = self.phonemize_string(self.remove_punctuation(chunk, lang), lang)
+            else:
+                phoneme_str = self._phonemize_with_lexicon(chunk, lang, lexicon)
+            # every chunk ends a sentence
+            yield from self._process_phones([(phoneme_str, punct, True)])
+
+    def _phonemize_with_lexicon(self, chunk: str, lang: str, lexicon: Lexicon) -> str:
+        """lexicon hits are substituted as given, only the remaining text is phonemized"""
+        segments = [(segment if is_ipa else self.remove_punctuation(segment, lang), is_ipa)
+                    for segment, is_ipa in lexicon.substitute(chunk)]
+        segments = [(segment, is_ipa) for segment, is_ipa in segments if segment]
+        # the text between lexicon hits is phonemized in one go
+        gaps = iter(self.phonemize_segments([segment for segment, is_ipa in segments if not is_ipa], lang))
+        return " ".join(segment if is_ipa else next(gaps) for segment, is_ipa in segments)
 
     @staticmethod
     def _process_phones(raw_phones: RawPhonemizedChunks) -> PhonemizedChunks:
@@ -51,7 +106,8 @@ class BasePhonemizer(metaclass=abc.ABCMeta):
         for phonemes_str, terminator_str, end_of_sentence in raw_phones:
             # Filter out (lang) switch (flags).
             # These surround words from languages other than the current voice.
-            phonemes_str = re.sub(r"\([^)]+\)", "", phonemes_str)
+            if "(" in phonemes_str:
+                phonemes_str = _LANG_SWITCH_FLAGS.sub("", phonemes_str)
             sentence_phonemes.extend(list(phonemes_str))
             if end_of_sentence:
                 all_phonemes.append(sentence_phonemes)
@@ -74,75 +130,59 @@ class BasePhonemizer(metaclass=abc.ABCMeta):
         Raises:
             ValueError: If the language code is unsupported.
         """
-        if target_lang in valid_langs:
-            return target_lang
-        best_lang = "und"
-        best_distance = 10000000
-        for l in valid_langs:
-            try:
-                distance: int = tag_distance(l, target_lang)
-            except:
-                try:
-                    l = f"{l.split('-')[0]}-{l.split('-')[1]}"
-                    distance: int = tag_distance(l, target_lang)
-                except:
-                    try:
-                        distance: int = tag_distance(l.split('-')[0], target_lang)
-                    except:
-                        continue
-            if distance < best_distance:
-                best_lang, best_distance = l, distance
-
-        # If the score is low (meaning a good match), return the language
-        if best_distance <= 10:
-            return best_lang
-        # Otherwise, raise an error for unsupported language
-        raise ValueError(f"unsupported language code: {target_lang}")
+        return _match_lang(target_lang, tuple(valid_langs))
 
     @staticmethod
-    def remove_punctuation(text):
+    def remove_punctuation(text, lang: Optional[str] = None):
         """
         Removes all punctuation characters from a string.
-        Punctuation characters are defined by string.punctuation.
+        Punctuation characters are defined by string.punctuation,
+        plus the punctuation of the segmenter rules of lang (eg. 。 for Chinese).
         """
-        # Create a regex pattern that matches any character in string.punctuation
-        punctuation_pattern = r"[" + re.escape(string.punctuation) + r"]"
-        return re.sub(punctuation_pattern, '', text).strip()
+        return remove_punctuation(text, lang)
 
     @staticmethod
-    def chunk_text(text: str, delimiters: Optional[List[str]] = None) -> TextChunks:
-        if not text:
-            return [('', '', True)]
-
-        results: TextChunks = []
-        delimiters = delimiters or [", ", ":", ";", "...", "|"]
-
-        # Create a regex pattern that matches any of the delimiters
-        delimiter_pattern = re.escape(delimiters[0])
-        for delimiter in delimiters[1:]:
-            delimiter_pattern += f"|{re.escape(delimiter)}"
-
-        for sentence in sentence_tokenize(text):
-            # Default punctuation if no specific punctuation found
-            default_punc = sentence[-1] if sentence and sentence[-1] in string.punctuation else "."
-
-            # Use regex to split the sentence by any of the delimiters
-            parts = re.split(f'({delimiter_pattern})', sentence)
-
-            # Group parts into chunks (text + delimiter)
-            chunks = []
-            for i in range(0, len(parts), 2):
-                # If there's a delimiter after the text, use it
-                delimiter = parts[i + 1] if i + 1 < len(parts) else default_punc
-
-                # Last chunk is marked as complete
-                is_last = (i + 2 >= len(parts))
-
-                chunks.append((parts[i].strip(), delimiter.strip(), is_last))
-
-            results.extend(chunks)
+    def chunk_text(text: str, delimiters: Optional[List[str]] = None, lang: Optional[str] = None) -> TextChunks:
+        """Split text into clauses, see segmenter.TextSegmenter for incremental text"""
+        return segment_text(text, lang, delimiters)
+
+
+@lru_cache(maxsize=32)
+def _comparable_tags(valid_langs: Sequence[str]) -> Tuple[str, ...]:
+    """Index of the first form of each tag that langcodes can parse, computed once per language list"""
+    tags = []
+    for l in valid_langs:
+        parts = l.split('-')
+        candidates = [l, f"{parts[0]}-{parts[1]}", parts[0]] if len(parts) > 1 else [l]
+        for candidate in candidates:
+            try:
+                tag_distance(candidate, candidate)
+            except:
+                continue
+            tags.append(candidate)
+            break
+    return tuple(tags)
+
+
+@lru_cache(maxsize=256)
+def _match_lang(target_lang: str, valid_langs: Tuple[str, ...]) -> str:
+    if target_lang in valid_langs:
+        return target_lang
+    best_lang = "und"
+    best_distance = 10000000
+    for l in _comparable_tags(valid_langs):
+        try:
+            distance: int = tag_distance(l, target_lang)
+        except:
+            continue
+        if distance < best_distance:
+            best_lang, best_distance = l, distance
 
-        return results
+    # If the score is low (meaning a good match), return the language
+    if best_distance <= 10:
+        return best_lang
+    # Otherwise, raise an error for unsupported language
+    raise ValueError(f"unsupported language code: {target_lang}")
 
 
 class UnicodeCodepointPhonemizer(BasePhonemizer):
@@ -150,15 +190,44 @@ class UnicodeCodepointPhonemizer(BasePhonemizer):
     normalization also splits accents and punctuation into it's own codepoints
     """
 
-    def __init__(self, form: Literal["NFC", "NFD", "NFKC", "NFKD"] = "NFD"):
+    def __init__(self, form: Literal["NFC", "NFD", "NFKC", "NFKD"] = "NFD",
+                 lexicons: Optional[Dict[str, Lexicon]] = None):
         self.form = form
-        super().__init__()
+        super().__init__(lexicons)
 
     def phonemize_string(self, text: str, lang: str) -> str:
         # Phonemes = codepoints
         return unicodedata.normalize(self.form, text)
 
 
+ESPEAK_VOICES = ['es-419', 'ca', 'qya', 'ga', 'et', 'ky', 'io', 'fa-latn', 'en-gb', 'fo', 'haw', 'kl',
+                 'ta', 'ml', 'gd', 'sd', 'es', 'hy', 'ur', 'ro', 'hi', 'or', 'ti', 'ca-va', 'om', 'tr', 'pa',
+                 'smj', 'mk', 'bg', 'cv', "fr", 'fi', 'en-gb-x-rp', 'ru', 'mt', 'an', 'mr', 'pap', 'vi', 'id',
+                 'fr-be', 'ltg', 'my', 'nl', 'shn', 'ba', 'az', 'cmn', 'da', 'as', 'sw',
+                 'piqd', 'en-us', 'hr', 'it', 'ug', 'th', 'mi', 'cy', 'ru-lv', 'ia', 'tt', 'hu', 'xex', 'te', 'ne',
+                 'eu', 'ja', 'bpy', 'hak', 'cs', 'en-gb-scotland', 'hyw', 'uk', 'pt', 'bn', 'mto', 'yue',
+                 'be', 'gu', 'sv', 'sl', 'cmn-latn-pinyin', 'lfn', 'lv', 'fa', 'sjn', 'nog', 'ms',
+                 'vi-vn-x-central', 'lt', 'kn', 'he', 'qu', 'ca-ba', 'quc', 'nb', 'sk', 'tn', 'py', 'si', 'de',
+                 'ar', 'en-gb-x-gbcwmd', 'bs', 'qdb', 'sq', 'sr', 'tk', 'en-029', 'ht', 'ru-cl', 'af', 'pt-br',
+                 'fr-ch', 'ka', 'en-gb-x-gbclan', 'ko', 'is', 'ca-nw', 'gn', 'kok', 'la', 'lb', 'am', 'kk', 'ku',
+                 'kaa', 'jbo', 'eo', 'uz', 'nci', 'vi-vn-x-south', 'el', 'pl', 'grc', ]
+
+# valid espeak voices that langcodes fails to normalize, only used when requested verbatim
+_UNMATCHABLE_ESPEAK_VOICES = ('chr-US-Qaaa-x-west', 'en-us-nyc', 'fr-fr')
+
+
+@lru_cache(maxsize=256)
+def get_espeak_voice(lang: str) -> str:
+    """espeak voice closest to a language code, raises ValueError if espeak does not support it"""
+    if lang.lower() == "en-gb":
+        return "en-gb-x-rp"
+    if lang in ESPEAK_VOICES or lang in _UNMATCHABLE_ESPEAK_VOICES:
+        return lang
+    if lang.lower().split("-")[0] in ESPEAK_VOICES:
+        return lang.lower().split("-")[0]
+    return _match_lang(lang, tuple(ESPEAK_VOICES))
+
+
 class EspeakError(Exception):
     """Custom exception for espeak-ng related errors."""
     pass
@@ -169,17 +238,7 @@ class EspeakPhonemizer(BasePhonemizer):
     A phonemizer class that uses the espeak-ng command-line tool to convert text into phonemes.
     It segments the input text heuristically based on punctuation to mimic clause-by-clause processing.
     """
-    ESPEAK_LANGS = ['es-419', 'ca', 'qya', 'ga', 'et', 'ky', 'io', 'fa-latn', 'en-gb', 'fo', 'haw', 'kl',
-                    'ta', 'ml', 'gd', 'sd', 'es', 'hy', 'ur', 'ro', 'hi', 'or', 'ti', 'ca-va', 'om', 'tr', 'pa',
-                    'smj', 'mk', 'bg', 'cv', "fr", 'fi', 'en-gb-x-rp', 'ru', 'mt', 'an', 'mr', 'pap', 'vi', 'id',
-                    'fr-be', 'ltg', 'my', 'nl', 'shn', 'ba', 'az', 'cmn', 'da', 'as', 'sw',
-                    'piqd', 'en-us', 'hr', 'it', 'ug', 'th', 'mi', 'cy', 'ru-lv', 'ia', 'tt', 'hu', 'xex', 'te', 'ne',
-                    'eu', 'ja', 'bpy', 'hak', 'cs', 'en-gb-scotland', 'hyw', 'uk', 'pt', 'bn', 'mto', 'yue',
-                    'be', 'gu', 'sv', 'sl', 'cmn-latn-pinyin', 'lfn', 'lv', 'fa', 'sjn', 'nog', 'ms',
-                    'vi-vn-x-central', 'lt', 'kn', 'he', 'qu', 'ca-ba', 'quc', 'nb', 'sk', 'tn', 'py', 'si', 'de',
-                    'ar', 'en-gb-x-gbcwmd', 'bs', 'qdb', 'sq', 'sr', 'tk', 'en-029', 'ht', 'ru-cl', 'af', 'pt-br',
-                    'fr-ch', 'ka', 'en-gb-x-gbclan', 'ko', 'is', 'ca-nw', 'gn', 'kok', 'la', 'lb', 'am', 'kk', 'ku',
-                    'kaa', 'jbo', 'eo', 'uz', 'nci', 'vi-vn-x-south', 'el', 'pl', 'grc', ]
+    ESPEAK_LANGS = ESPEAK_VOICES
 
     @classmethod
     def get_lang(cls, target_lang: str) -> str:
@@ -195,13 +254,7 @@ class EspeakPhonemizer(BasePhonemizer):
         Raises:
             ValueError: If the language code is unsupported.
         """
-        if target_lang.lower() == "en-gb":
-            return "en-gb-x-rp"
-        if target_lang in cls.ESPEAK_LANGS:
-            return target_lang
-        if target_lang.lower().split("-")[0] in cls.ESPEAK_LANGS:
-            return target_lang.lower().split("-")[0]
-        return cls.match_lang(target_lang, cls.ESPEAK_LANGS)
+        return get_espeak_voice(target_lang)
 
     @staticmethod
     def _run_espeak_command(args: List[str], input_text: str = None, check: bool = True) -> str:
@@ -254,6 +307,20 @@ class EspeakPhonemizer(BasePhonemizer):
             input_text=text
         )
 
+    def phonemize_segments(self, segments: List[str], lang: str) -> List[str]:
+        """phonemize several pieces of text with a single espeak-ng process
+
+        every piece is sent as its own paragraph, espeak-ng writes the phonemes of each one on its own line.
+        Falls back to one process per piece if the output can not be split back into the pieces"""
+        if len(segments) < 2:
+            return super().phonemize_segments(segments, lang)
+        lines = [line.strip() for line in self.phonemize_string("\n\n".join(segments), lang).splitlines()]
+        lines = [line for line in lines if line]
+        if len(lines) == len(segments):
+            return lines
+        LOG.debug(f"espeak-ng returned {len(lines)} lines for {len(segments)} segments, phonemizing one by one")
+        return super().phonemize_segments(segments, lang)
+
 
 if __name__ == "__main__":
     pho = EspeakPhonemizer()
@@ -0,0 +1,179 @@
+"""User pronunciation lexicons
+
+One file per language, named after the language (`en-us.txt`, `pt.tsv`), with one entry per line
+
+    # word(s)<TAB>ipa
+    OpenVoiceOS	ˈoʊpən vɔɪs oʊ ɛs
+    Mycroft AI	ˈmaɪkɹɒft eɪ aɪ
+
+Entries may span several words and are matched case-insensitively, the longest entry wins.
+Words containing symbols (`C++`, `AT&T`) are matched literally, as whole words.
+Files are compiled into a word trie that is cached on disk next to a fingerprint of the source file,
+the cache is only rebuilt when the source changes.
+"""
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+from ovos_utils.log import LOG
+from ovos_utils.xdg_utils import xdg_cache_home
+
+CACHE_DIR = f"{xdg_cache_home()}/piper_tts/lexicons"
+CACHE_VERSION = 2
+LEXICON_EXTENSIONS = (".txt", ".tsv")
+
+_WORD_PATTERN = r"\w+(?:['’-]\w+)*"
+_WORD = re.compile(_WORD_PATTERN)
+_END = ""  # trie key holding the IPA of an entry, words are never empty
+
+# list of (text, is_ipa) segments
+LexiconSegments = List[Tuple[str, bool]]
+
+
+class Lexicon:
+    def __init__(self, trie: Optional[Dict[str, Any]] = None):
+        self.trie: Dict[str, Any] = trie or {}
+        # entry words that are not plain words, eg. "c++", the tokenizer matches them literally
+        self._symbol_words: Set[str] = set()
+        self._tokenizer: Optional["re.Pattern"] = _WORD
+        stack = [self.trie]
+        while stack:
+            node = stack.pop()
+            for word, child in node.items():
+                if word != _END:
+                    self._add_word(word)
+                    stack.append(child)
+
+    def __len__(self) -> int:
+        count, stack = 0, [self.trie]
+        while stack:
+            node = stack.pop()
+            count += _END in node
+            stack += [child for word, child in node.items() if word != _END]
+        return count
+
+    def _add_word(self, word: str):
+        if word not in self._symbol_words and not _WORD.fullmatch(word):
+            self._symbol_words.add(word)
+            self._tokenizer = None
+
+    @property
+    def tokenizer(self) -> "re.Pattern":
+        """finds the words of a text, symbol words of the entries are tried first, longest first"""
+        if self._tokenizer is None:
+            symbol_words = "|".join(re.escape(w) for w in sorted(self._symbol_words, key=len, reverse=True))
+            self._tokenizer = re.compile(f"(?<!\\w)(?:{symbol_words})(?!\\w)|{_WORD_PATTERN}", re.IGNORECASE)
+        return self._tokenizer
+
+    def add(self, words: str, ipa: str):
+        """words are separated by whitespace, words with symbols are matched literally"""
+        node = self.trie
+        for word in words.split():
+            word = word.casefold()
+            self._add_word(word)
+            node = node.setdefault(word, {})
+        if node is not self.trie:
+            node[_END] = ipa
+
+    def substitute(self, text: str) -> LexiconSegments:
+        """split text into lexicon hits (ipa) and the remaining text, longest match first"""
+        words = list(self.tokenizer.finditer(text))
+        if not any(w.group().casefold() in self.trie for w in words):
+            return [(text, False)]
+
+        segments: LexiconSegments = []
+        pos = idx = 0
+        while idx < len(words):
+            node, match = self.trie, None
+            end = idx
+            while end < len(words) and words[end].group().casefold() in node:
+                # multi word entries only match words separated by whitespace
+                if end > idx and not text[words[end - 1].end():words[end].start()].isspace():
+                    break
+                node = node[words[end].group().casefold()]
+                end += 1
+                if _END in node:
+                    match = (end, node[_END])
+            if match is None:
+                idx += 1
+                continue
+            end, ipa = match
+            if text[pos:words[idx].start()].strip():
+                segments.append((text[pos:words[idx].start()], False))
+            segments.append((ipa, True))
+            pos, idx = words[end - 1].end(), end
+        if text[pos:].strip():
+            segments.append((text[pos:], False))
+        return segments
+
+    @staticmethod
+    def parse(path: Union[str, Path]) -> "Lexicon":
+        lexicon = Lexicon()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if "\t" not in line:
+                    LOG.warning(f"Ignoring malformed lexicon line in {path}: {line}")
+                    continue
+                words, ipa = line.split("\t", 1)
+                lexicon.add(words, ipa.strip())
+        return lexicon
+
+    @staticmethod
+    def load(path: Union[str, Path], cache_dir: Optional[str] = CACHE_DIR) -> "Lexicon":
+        """load a lexicon file, the compiled trie is reused from cache_dir while the file is unchanged"""
+        path = Path(path).absolute()
+        if not cache_dir:
+            return Lexicon.parse(path)
+
+        stat = path.stat()
+        fingerprint = [CACHE_VERSION, stat.st_mtime_ns, stat.st_size]
+        cache_path = Path(cache_dir) / f"{hashlib.sha1(str(path).encode('utf-8')).hexdigest()}.json"
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached["fingerprint"] == fingerprint:
+                return Lexicon(cached["trie"])
+        except (OSError, ValueError, KeyError):
+            pass  # missing or stale cache
+
+        lexicon = Lexicon.parse(path)
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # several processes may compile the same lexicon, swap the finished file in
+            tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"source": str(path), "fingerprint": fingerprint, "trie": lexicon.trie},
+                          f, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            LOG.warning(f"Failed to cache compiled lexicon {path}: {e}")
+        LOG.debug(f"Compiled lexicon {path}: {len(lexicon)} entries")
+        return lexicon
+
+
+def load_lexicons(lexicons: Union[str, Path, Dict[str, str]],
+                  cache_dir: Optional[str] = CACHE_DIR) -> Dict[str, Lexicon]:
+    """lang -> Lexicon
+
+    Args:
+        lexicons: a directory of per-language files, or a {lang: file} mapping
+        cache_dir: where compiled lexicons are cached, None disables the cache
+    """
+    if isinstance(lexicons, dict):
+        files = {lang: Path(path).expanduser() for lang, path in lexicons.items()}
+    else:
+        files = {p.stem: p for p in sorted(Path(lexicons).expanduser().iterdir())
+                 if p.suffix in LEXICON_EXTENSIONS}
+    loaded = {}
+    for lang, path in files.items():
+        try:
+            loaded[lang.lower()] = Lexicon.load(path, cache_dir)
+        except OSError as e:
+            LOG.error(f"Failed to load lexicon {path}: {e}")
+    return loaded
@@ -1,25 +1,53 @@
 import json
+import os
+import re
+import threading
+import time
 import wave
-from dataclasses import dataclass
+import weakref
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, Mapping, Sequence, Iterable, List, Optional, Tuple, Union
+from typing import Any, Dict, Mapping, Sequence, Iterable, Iterator, List, Optional, Sized, Tuple, Union
 
 import numpy as np
 import onnxruntime
+from ovos_tts_plugin_piper.cancel import CancelToken
 from ovos_tts_plugin_piper.espeak_wrapper import EspeakPhonemizer, UnicodeCodepointPhonemizer
+from ovos_tts_plugin_piper.tashkeel import get_diacritizer
 from ovos_utils.log import LOG
 
 PAD = "_"  # padding (0)
 BOS = "^"  # beginning of sentence
 EOS = "$"  # end of sentence
 
+# padded input lengths used by the IO binding path,
+# a handful of fixed shapes lets ORT reuse its memory patterns across calls
+PHONEME_ID_BUCKETS = (32, 64, 128, 256, 512, 1024)
+# inline phonemes inside text, eg. "my name is [[ dʒɑːn ]]", bypass espeak
+PHONEME_MARKUP = re.compile(r"\[\[\s*(.+?)\s*\]\]")
+# pre-phonemized sentence, an IPA string, a list of phonemes or a list of phoneme ids
+PhonemeInput = Union[str, Sequence[str], Sequence[int]]
+# synthetic input lengths used to warm up freshly loaded models
+WARMUP_LENGTHS = (32, 64, 128, 256)
+# streaming models decode this many latent frames at a time (~0.37s of audio at 22050Hz)
+DECODER_WINDOW_FRAMES = 32
+# frames of context decoded on each side of a window and then dropped, avoids clicks at window edges
+DECODER_WINDOW_PADDING = 8
+
 
 class PhonemeType(str, Enum):
     ESPEAK = "espeak"
     TEXT = "text"
 
 
+class ModelType(str, Enum):
+    VITS = "vits"
+    """single graph, phoneme ids in, whole waveform out"""
+    STREAMING = "streaming"
+    """split export, encoder.onnx (phoneme ids -> latent frames) + decoder.onnx (latent frames -> waveform)"""
+
+
 @dataclass
 class PiperConfig:
     """Piper configuration"""
@@ -46,8 +74,17 @@ class PiperConfig:
     phoneme_type: PhonemeType
     """espeak or text"""
 
+    model_type: ModelType = ModelType.VITS
+    """monolithic or split encoder/decoder export, detected from the config and the model files"""
+
+    @staticmethod
+    def detect_model_type(config: Dict[str, Any], model_path: Optional[Union[str, Path]] = None) -> ModelType:
+        if config.get("streaming") or (model_path is not None and get_streaming_model_files(model_path)):
+            return ModelType.STREAMING
+        return ModelType.VITS
+
     @staticmethod
-    def from_dict(config: Dict[str, Any]) -> "PiperConfig":
+    def from_dict(config: Dict[str, Any], model_path: Optional[Union[str, Path]] = None) -> "PiperConfig":
         inference = config.get("inference", {})
 
         return PiperConfig(
@@ -61,35 +98,313 @@ class PiperConfig:
             espeak_voice=config["espeak"]["voice"],
             phoneme_id_map=config["phoneme_id_map"],
             phoneme_type=PhonemeType(config.get("phoneme_type", PhonemeType.ESPEAK)),
+            model_type=PiperConfig.detect_model_type(config, model_path),
         )
 
 
+def get_streaming_model_files(model_path: Union[str, Path]) -> Optional[Tuple[Path, Path]]:
+    """(encoder, decoder) of a split export, model_path is the export directory or its encoder file"""
+    model_path = Path(model_path)
+    if model_path.is_dir():
+        encoder, decoder = model_path / "encoder.onnx", model_path / "decoder.onnx"
+    elif "encoder" in model_path.name:
+        encoder = model_path
+        decoder = model_path.with_name(model_path.name.replace("encoder", "decoder"))
+    else:
+        return None
+    if encoder.is_file() and decoder.is_file():
+        return encoder, decoder
+    return None
+
+
+def get_model_config_path(model_path: Union[str, Path]) -> Union[str, Path]:
+    """default config file of a model, <model>.onnx.json or config.json inside a split export directory
+
+    urls are returned as a <url>.json string, Path would collapse the // of the scheme"""
+    if isinstance(model_path, str) and model_path.startswith("http"):
+        return f"{model_path}.json"
+    model_path = Path(model_path)
+    if model_path.is_dir():
+        return model_path / "config.json"
+    config_path = Path(f"{model_path}.json")
+    if not config_path.exists() and (model_path.parent / "config.json").exists():
+        return model_path.parent / "config.json"
+    return config_path
+
+
+class SharedEnvironment:
+    """Process wide onnxruntime environment shared by every piper session
+
+    - intra/inter op thread pools are created once for the process instead of once per session
+    - a single CPU arena allocator is registered in the environment and used by all sessions
+    - sessions are cached per model file, loading the same model twice reuses the session
+      (and its prepacked weights), onnxruntime sessions are safe to run from several threads
+    - the cache holds weak references, a session is freed once no loaded voice uses it anymore
+    """
+    enabled = False
+    _sessions: "weakref.WeakValueDictionary[Tuple[str, Tuple[str, ...]], onnxruntime.InferenceSession]" = \
+        weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, intra_op_num_threads: int = 0, inter_op_num_threads: int = 0) -> bool:
+        """Create the global thread pools, needs to happen before the first session is created.
+
+        Args:
+            intra_op_num_threads (int): threads used inside an operator, 0 lets onnxruntime pick
+            inter_op_num_threads (int): threads used to run operators in parallel, 0 lets onnxruntime pick
+
+        Returns:
+            bool: True if the shared environment is in use
+        """
+        if cls.enabled:
+            return True
+        from onnxruntime.capi import _pybind_state
+        try:
+            _pybind_state.set_global_thread_pool_sizes(intra_op_num_threads, inter_op_num_threads)
+            cpu_info = onnxruntime.OrtMemoryInfo("Cpu", onnxruntime.OrtAllocatorType.ORT_ARENA_ALLOCATOR,
+                                                 0, onnxruntime.OrtMemType.DEFAULT)
+            _pybind_state.create_and_register_allocator(cpu_info, None)
+        except Exception as e:
+            LOG.warning(f"Failed to create shared onnxruntime environment, using per session threads: {e}")
+            return False
+        cls.enabled = True
+        return True
+
+    @classmethod
+    def session_options(cls, session_config: Optional[Dict[str, str]] = None,
+                        shared: bool = True) -> onnxruntime.SessionOptions:
+        sess_options = onnxruntime.SessionOptions()
+        for key, value in (session_config or {}).items():
+            sess_options.add_session_config_entry(key, value)
+        if shared and cls.enabled:
+            sess_options.use_per_session_threads = False
+            sess_options.add_session_config_entry("session.use_env_allocators", "1")
+        return sess_options
+
+    @classmethod
+    def get_session(cls, model_path: Union[str, Path], providers: List,
+                    session_config: Optional[Dict[str, str]] = None) -> onnxruntime.InferenceSession:
+        """Create an InferenceSession, reusing an existing one for the same model when the shared environment is enabled"""
+        if not cls.enabled:
+            return onnxruntime.InferenceSession(str(model_path),
+                                                sess_options=cls.session_options(session_config, shared=False),
+                                                providers=providers)
+        key = (str(Path(model_path).resolve()),
+               tuple(p if isinstance(p, str) else p[0] for p in providers),
+               tuple(sorted((session_config or {}).items())))
+        with cls._lock:
+            # keep a strong reference until returned, the cache alone does not keep the session alive
+            session = cls._sessions.get(key)
+            if session is None:
+                try:
+                    session = onnxruntime.InferenceSession(str(model_path),
+                                                           sess_options=cls.session_options(session_config),
+                                                           providers=providers)
+                except Exception as e:
+                    LOG.warning(f"Failed to create session in shared onnxruntime environment: {e}")
+                    return onnxruntime.InferenceSession(str(model_path),
+                                                        sess_options=cls.session_options(session_config,
+                                                                                         shared=False),
+                                                        providers=providers)
+                cls._sessions[key] = session
+            return session
+
+
+def get_mmap_model(model_path: Union[str, Path], alignment: int = 65536) -> Path:
+    """Re-save a model with its weights as page aligned external data, next to the original file
+
+    onnxruntime memory maps aligned external initializers instead of copying them into the process heap,
+    every process loading the model then shares the same pages from the page cache.
+    The converted model is rebuilt only when the original file changes.
+
+    Requires the optional `onnx` package, the original path is returned if conversion is not possible.
+
+    Args:
+        model_path: path to the .onnx model
+        alignment: offset alignment of each initializer, must be a multiple of the page size
+
+    Returns:
+        Path: path to the model to load
+    """
+    model_path = Path(model_path)
+    mmap_path = model_path.with_suffix(".mmap.onnx")
+    data_path = model_path.with_suffix(".mmap.onnx.data")
+    if mmap_path.exists() and data_path.exists() and \
+            mmap_path.stat().st_mtime >= model_path.stat().st_mtime:
+        return mmap_path
+
+    try:
+        import onnx
+        from onnx.external_data_helper import set_external_data
+    except ImportError:
+        LOG.error("Failed to convert model for memory mapping, is onnx installed?")
+        return model_path
+
+    # write to temporary files and rename, other processes may be mapping the previous files
+    tmp_suffix = f".{os.getpid()}.tmp"
+    tmp_data_path = data_path.with_name(data_path.name + tmp_suffix)
+    tmp_mmap_path = mmap_path.with_name(mmap_path.name + tmp_suffix)
+    try:
+        model = onnx.load(str(model_path))
+        with open(tmp_data_path, "wb") as data_file:
+            for tensor in model.graph.initializer:
+                if len(tensor.raw_data) < alignment:
+                    continue  # small tensors stay inline
+                data_file.write(bytes(-data_file.tell() % alignment))
+                offset = data_file.tell()
+                data_file.write(tensor.raw_data)
+                set_external_data(tensor, data_path.name, offset, len(tensor.raw_data))
+                tensor.ClearField("raw_data")
+                tensor.data_location = onnx.TensorProto.EXTERNAL
+        os.replace(tmp_data_path, data_path)
+        onnx.save(model, str(tmp_mmap_path))
+        os.replace(tmp_mmap_path, mmap_path)
+    except Exception as e:
+        LOG.error(f"Failed to convert {model_path} for memory mapping: {e}")
+        for path in (tmp_data_path, tmp_mmap_path):
+            if path.exists():
+                path.unlink()
+        return model_path
+    LOG.info(f"Converted {model_path} for memory mapping: {mmap_path}")
+    return mmap_path
+
+
 def audio_float_to_int16(
-        audio: np.ndarray, max_wav_value: float = 32767.0
+        audio: np.ndarray, max_wav_value: float = 32767.0, normalize: bool = True
 ) -> np.ndarray:
-    """Normalize audio and convert to int16 range"""
-    audio_norm = audio * (max_wav_value / max(0.01, np.max(np.abs(audio))))
+    """Normalize audio and convert to int16 range
+
+    streamed windows are not normalized, the peak of the whole sentence is not known yet"""
+    if normalize:
+        audio_norm = audio * (max_wav_value / max(0.01, np.max(np.abs(audio))))
+    else:
+        audio_norm = audio * max_wav_value
     audio_norm = np.clip(audio_norm, -max_wav_value, max_wav_value)
     audio_norm = audio_norm.astype("int16")
     return audio_norm
 
 
+class IOBindingRunner:
+    """Runs a piper session through ORT IO binding, reusing preallocated OrtValues
+
+    phoneme ids are padded into a few bucketed lengths, one preallocated input tensor per bucket,
+    scales and sid tensors are cached per parameter set
+    """
+
+    def __init__(self, session: onnxruntime.InferenceSession,
+                 pad_id: int = 0,
+                 buckets: Sequence[int] = PHONEME_ID_BUCKETS):
+        self.session = session
+        self.pad_id = pad_id
+        self.buckets = sorted(buckets)
+        self.device = "cuda" if "CUDAExecutionProvider" in session.get_providers() else "cpu"
+        self.output_name = session.get_outputs()[0].name
+        self.binding = session.io_binding()
+        self.lock = threading.Lock()
+        # bucket -> (staging array, OrtValue)
+        self._inputs: Dict[int, Tuple[np.ndarray, onnxruntime.OrtValue]] = {}
+        self._lengths = np.zeros((1,), dtype=np.int64)
+        self._lengths_value = self._allocate(self._lengths)
+        self._scales: Dict[Tuple[float, float, float], onnxruntime.OrtValue] = {}
+        self._sids: Dict[int, onnxruntime.OrtValue] = {}
+
+    def _allocate(self, array: np.ndarray) -> onnxruntime.OrtValue:
+        value = onnxruntime.OrtValue.ortvalue_from_shape_and_type(array.shape, array.dtype, self.device, 0)
+        value.update_inplace(array)
+        return value
+
+    def get_bucket(self, num_ids: int) -> Optional[int]:
+        """smallest bucket that fits num_ids, None if longer than the biggest bucket"""
+        for bucket in self.buckets:
+            if num_ids <= bucket:
+                return bucket
+        return None
+
+    def _get_input(self, phoneme_ids: List[int]) -> onnxruntime.OrtValue:
+        num_ids = len(phoneme_ids)
+        bucket = self.get_bucket(num_ids)
+        if bucket is None:
+            # too long to be worth keeping around
+            return self._allocate(np.array([phoneme_ids], dtype=np.int64))
+        if bucket not in self._inputs:
+            staging = np.full((1, bucket), self.pad_id, dtype=np.int64)
+            self._inputs[bucket] = (staging, self._allocate(staging))
+        staging, value = self._inputs[bucket]
+        staging[0, :num_ids] = phoneme_ids
+        staging[0, num_ids:] = self.pad_id
+        value.update_inplace(staging)
+        return value
+
+    def _get_scales(self, noise_scale: float, length_scale: float, noise_w: float) -> onnxruntime.OrtValue:
+        key = (noise_scale, length_scale, noise_w)
+        if key not in self._scales:
+            self._scales[key] = self._allocate(np.array(key, dtype=np.float32))
+        return self._scales[key]
+
+    def _get_sid(self, speaker_id: int) -> onnxruntime.OrtValue:
+        if speaker_id not in self._sids:
+            self._sids[speaker_id] = self._allocate(np.array([speaker_id], dtype=np.int64))
+        return self._sids[speaker_id]
+
+    def run(self, phoneme_ids: List[int],
+            noise_scale: float, length_scale: float, noise_w: float,
+            speaker_id: Optional[int] = None) -> np.ndarray:
+        """returns the raw float audio output of the model"""
+        with self.lock:
+            self._lengths[0] = len(phoneme_ids)
+            self._lengths_value.update_inplace(self._lengths)
+
+            self.binding.clear_binding_inputs()
+            self.binding.clear_binding_outputs()
+            self.binding.bind_ortvalue_input("input", self._get_input(phoneme_ids))
+            self.binding.bind_ortvalue_input("input_lengths", self._lengths_value)
+            self.binding.bind_ortvalue_input("scales", self._get_scales(noise_scale, length_scale, noise_w))
+            if speaker_id is not None:
+                self.binding.bind_ortvalue_input("sid", self._get_sid(speaker_id))
+            # output length depends on predicted durations, let ORT allocate it
+            self.binding.bind_output(self.output_name, self.device)
+
+            self.session.run_with_iobinding(self.binding)
+            return self.binding.copy_outputs_to_cpu()[0]
+
+
 @dataclass
 class PiperVoice:
     session: onnxruntime.InferenceSession
     config: PiperConfig
     phonemizer: EspeakPhonemizer = EspeakPhonemizer()
     unicode_phonemizer: UnicodeCodepointPhonemizer = UnicodeCodepointPhonemizer()
+    use_io_binding: bool = False
+    """reuse preallocated ORT inputs across calls, see IOBindingRunner"""
+    decoder: Optional[onnxruntime.InferenceSession] = None
+    """decoder of a split streaming export, session is then the encoder"""
+    _io_binding: Optional[IOBindingRunner] = field(default=None, init=False, repr=False)
+    metrics: Dict[str, float] = field(default_factory=dict, init=False)
+    """load metrics in seconds, eg. load_time and warmup_time"""
+
+    @property
+    def io_binding(self) -> Optional[IOBindingRunner]:
+        if self.use_io_binding and self._io_binding is None and self.decoder is None:
+            self._io_binding = IOBindingRunner(self.session,
+                                               pad_id=self.config.phoneme_id_map[PAD][0])
+        return self._io_binding
 
     @staticmethod
     def load(
             model_path: Union[str, Path],
             config_path: Optional[Union[str, Path]] = None,
             use_cuda: bool = False,
+            use_io_binding: bool = False,
+            warmup: bool = False,
+            use_mmap: bool = False
     ) -> "PiperVoice":
-        """Load an ONNX model and config."""
+        """Load an ONNX model and config, optionally running a warm-up before returning.
+
+        model_path is a .onnx file, or for split streaming exports the export directory or its encoder file"""
+        start = time.monotonic()
         if config_path is None:
-            config_path = f"{model_path}.json"
+            config_path = get_model_config_path(model_path)
 
         with open(config_path, "r", encoding="utf-8") as config_file:
             config_dict = json.load(config_file)
@@ -105,34 +420,169 @@ class PiperVoice:
         else:
             providers = ["CPUExecutionProvider"]
 
-        return PiperVoice(
-            config=PiperConfig.from_dict(config_dict),
-            session=onnxruntime.InferenceSession(
-                str(model_path),
-                sess_options=onnxruntime.SessionOptions(),
-                providers=providers,
-            ),
+        config = PiperConfig.from_dict(config_dict, model_path)
+        decoder_path = None
+        if config.model_type == ModelType.STREAMING:
+            streaming_files = get_streaming_model_files(model_path)
+            if streaming_files is None:
+                raise FileNotFoundError(f"encoder.onnx/decoder.onnx of streaming model not found: {model_path}")
+            model_path, decoder_path = streaming_files
+            if use_io_binding:
+                LOG.warning("IO binding is not supported for streaming models, ignoring use_io_binding")
+
+        session_config = {}
+        if use_mmap:
+            model_path = get_mmap_model(model_path)
+            if decoder_path is not None:
+                decoder_path = get_mmap_model(decoder_path)
+            # prepacking copies weights into private buffers, keep them in the mapped pages instead
+            session_config["session.disable_prepacking"] = "1"
+
+        voice = PiperVoice(
+            config=config,
+            session=SharedEnvironment.get_session(model_path, providers, session_config),
+            use_io_binding=use_io_binding,
+            decoder=SharedEnvironment.get_session(decoder_path, providers, session_config)
+            if decoder_path is not None else None
         )
+        voice.metrics["load_time"] = time.monotonic() - start
+        if warmup:
+            voice.warmup()
+        return voice
+
+    def warmup(self, lengths: Sequence[int] = WARMUP_LENGTHS) -> float:
+        """Run synthetic phoneme sequences through the model and warm the espeak voice.
+
+        The first session.run pays for arena growth and kernel setup,
+        doing it here keeps that cost out of the first real request.
 
-    def phonemize(self, text: str, phonemizer_lang: Optional[str] = None) -> List[List[str]]:
-        """Text to phonemes grouped by sentence."""
+        Returns:
+            float: warm-up time in seconds, also stored in metrics["warmup_time"]
+        """
+        start = time.monotonic()
+        if self.config.phoneme_type == PhonemeType.ESPEAK:
+            try:
+                self.phonemizer.phonemize_string("warm up", self.config.espeak_voice)
+            except Exception as e:
+                LOG.warning(f"Failed to warm up espeak voice '{self.config.espeak_voice}': {e}")
+            if self.config.espeak_voice == "ar":
+                get_diacritizer().warmup()
+
+        id_map = self.config.phoneme_id_map
+        filler = next((ids for pho, ids in id_map.items() if pho not in (PAD, BOS, EOS)), id_map[PAD])
+        bos, eos, pad = list(id_map[BOS]), list(id_map[EOS]), list(id_map[PAD])
+        for length in lengths:
+            body = (list(filler) + pad) * length
+            phoneme_ids = bos + body[:max(length - len(bos) - len(eos), 0)] + eos
+            self.synthesize_ids_to_raw(phoneme_ids)
+
+        self.metrics["warmup_time"] = time.monotonic() - start
+        LOG.debug(f"Piper warm-up took {self.metrics['warmup_time']:.3f}s")
+        return self.metrics["warmup_time"]
+
+    def phonemize(self, text: str, phonemizer_lang: Optional[str] = None,
+                  cancel_token: Optional[CancelToken] = None) -> List[List[str]]:
+        """Text to phonemes grouped by sentence.
+
+        Phonemes inside [[ ]] markup are used as given, only the text around them is phonemized."""
+        return list(self.iter_phonemize(text, phonemizer_lang, cancel_token))
+
+    def iter_phonemize(self, text: str, phonemizer_lang: Optional[str] = None,
+                       cancel_token: Optional[CancelToken] = None) -> Iterator[List[str]]:
+        """Like phonemize, but every sentence is yielded as soon as it is ready,
+        the rest of the text is only preprocessed and phonemized when the next sentence is requested.
+
+        Raises ValueError before the first sentence if inline [[ ]] phonemes are not supported by this voice."""
+        if PHONEME_MARKUP.search(text):
+            for phonemes in PHONEME_MARKUP.findall(text):
+                self.validate_phonemes(list(phonemes))
+            return self._iter_phonemize_markup(text, phonemizer_lang, cancel_token)
+        return self._iter_phonemize_text(text, phonemizer_lang, cancel_token)
+
+    def _iter_phonemize_markup(self, text: str, phonemizer_lang: Optional[str] = None,
+                               cancel_token: Optional[CancelToken] = None) -> Iterator[List[str]]:
+        pending: Optional[List[str]] = None  # last sentence, the next segment may continue it
+        continues = False  # next segment belongs to the pending sentence
+        for idx, segment in enumerate(PHONEME_MARKUP.split(text)):
+            if idx % 2:  # inline phonemes
+                phonemes = list(segment)
+                if continues and pending is not None:
+                    pending += [" "] + phonemes
+                else:
+                    if pending is not None:
+                        yield pending
+                    pending = phonemes
+                continues = True
+            elif segment.strip():
+                first = True
+                for sentence in self._iter_phonemize_text(segment, phonemizer_lang, cancel_token):
+                    if not sentence:
+                        continue
+                    if first and continues and pending is not None:
+                        pending += [" "] + sentence
+                    else:
+                        if pending is not None:
+                            yield pending
+                        pending = sentence
+                    first = False
+                continues = segment.rstrip()[-1] not in ".!?"
+                if not continues and pending is not None:
+                    yield pending
+                    pending = None
+        if pending is not None:
+            yield pending
+
+    def _iter_phonemize_text(self, text: str, phonemizer_lang: Optional[str] = None,
+                             cancel_token: Optional[CancelToken] = None) -> Iterator[List[str]]:
         if self.config.phoneme_type == PhonemeType.ESPEAK:
             phonemizer_lang: str = phonemizer_lang or self.config.espeak_voice
             if phonemizer_lang == "ar":
-                # Arabic diacritization
-                # https://github.com/mush42/libtashkeel/
-                try:
-                    from piper_phonemize import tashkeel_run
-                    text = tashkeel_run(text)
-                except:
-                    LOG.error("Failed to run tashkeel diacritizer, is piper-phonemize installed?")
-            return self.phonemizer.phonemize(text, phonemizer_lang)
+                # Arabic diacritization, per chunk, right before the chunk is phonemized
+                diacritizer = get_diacritizer()
+                for sentence in self.phonemizer.iter_phonemize(text, phonemizer_lang, cancel_token,
+                                                               preprocess=diacritizer):
+                    self.metrics.update({f"tashkeel_{k}": v for k, v in diacritizer.metrics.items()})
+                    yield sentence
+                return
+            yield from self.phonemizer.iter_phonemize(text, phonemizer_lang, cancel_token)
+            return
 
         if self.config.phoneme_type == PhonemeType.TEXT:
-            return self.unicode_phonemizer.phonemize(text, phonemizer_lang)
+            yield from self.unicode_phonemizer.iter_phonemize(text, phonemizer_lang, cancel_token)
+            return
 
         raise ValueError(f"Unexpected phoneme type: {self.config.phoneme_type}")
 
+    def validate_phonemes(self, phonemes: Sequence[str]) -> List[str]:
+        """Raises ValueError if any phoneme is missing from phoneme_id_map"""
+        missing = sorted({p for p in phonemes if p not in self.config.phoneme_id_map})
+        if missing:
+            raise ValueError(f"Phonemes not supported by this voice: {missing}")
+        return list(phonemes)
+
+    def validate_phoneme_ids(self, phoneme_ids: Sequence[int]) -> List[int]:
+        """Raises ValueError if any id is outside of the model's symbol table"""
+        invalid = sorted({i for i in phoneme_ids if not 0 <= i < self.config.num_symbols})
+        if invalid:
+            raise ValueError(f"Phoneme ids not supported by this voice: {invalid}")
+        return list(phoneme_ids)
+
+    def sentence_to_ids(self, sentence: PhonemeInput) -> List[int]:
+        """Pre-phonemized sentence to ids.
+
+        Args:
+            sentence: an IPA string, a list of phonemes,
+                or a list of phoneme ids including BOS/EOS/PAD as returned by phonemes_to_ids
+
+        Raises:
+            ValueError: if the phonemes or ids are not supported by this voice
+        """
+        if isinstance(sentence, str):
+            sentence = list(sentence)
+        if sentence and all(isinstance(p, int) for p in sentence):
+            return self.validate_phoneme_ids(sentence)
+        return self.phonemes_to_ids(self.validate_phonemes(sentence))
+
     def phonemes_to_ids(self, phonemes: List[str]) -> List[int]:
         """Phonemes to ids."""
         id_map = self.config.phoneme_id_map
@@ -159,13 +609,13 @@ class PiperVoice:
             noise_scale: Optional[float] = None,
             noise_w: Optional[float] = None,
             sentence_silence: float = 0.0,
-            phonemizer_lang: Optional[str] = None
+            phonemizer_lang: Optional[str] = None,
+            cancel_token: Optional[CancelToken] = None
     ):
-        """Synthesize WAV audio from text."""
-        wav_file.setframerate(self.config.sample_rate)
-        wav_file.setsampwidth(2)  # 16-bit
-        wav_file.setnchannels(1)  # mono
+        """Synthesize WAV audio from text.
 
+        Raises SynthesisCancelled if cancel_token is cancelled or expires before the last sentence."""
+        self._set_wav_format(wav_file)
         for audio_bytes in self.synthesize_stream_raw(
                 text,
                 speaker_id=speaker_id,
@@ -173,7 +623,8 @@ class PiperVoice:
                 noise_scale=noise_scale,
                 noise_w=noise_w,
                 sentence_silence=sentence_silence,
-                phonemizer_lang=phonemizer_lang
+                phonemizer_lang=phonemizer_lang,
+                cancel_token=cancel_token
         ):
             wav_file.writeframes(audio_bytes)
 
@@ -185,17 +636,112 @@ class PiperVoice:
             noise_scale: Optional[float] = None,
             noise_w: Optional[float] = None,
             sentence_silence: float = 0.0,
-            phonemizer_lang: Optional[str] = None
+            phonemizer_lang: Optional[str] = None,
+            cancel_token: Optional[CancelToken] = None
     ) -> Iterable[bytes]:
-        """Synthesize raw audio per sentence from text."""
-        sentence_phonemes = self.phonemize(text, phonemizer_lang)
+        """Synthesize raw audio per sentence from text.
+
+        Text is phonemized one sentence at a time, each sentence is synthesized before the next one is phonemized.
+
+        Raises SynthesisCancelled if cancel_token is cancelled or expires, checked before each sentence."""
+        sentence_phonemes = self.iter_phonemize(text, phonemizer_lang, cancel_token)
+        yield from self._synthesize_sentences(
+            (self.phonemes_to_ids(phonemes) for phonemes in sentence_phonemes),
+            speaker_id=speaker_id,
+            length_scale=length_scale,
+            noise_scale=noise_scale,
+            noise_w=noise_w,
+            sentence_silence=sentence_silence,
+            cancel_token=cancel_token
+        )
 
+    def synthesize_phonemes(
+            self,
+            sentences: Sequence[PhonemeInput],
+            wav_file: wave.Wave_write,
+            speaker_id: Optional[int] = None,
+            length_scale: Optional[float] = None,
+            noise_scale: Optional[float] = None,
+            noise_w: Optional[float] = None,
+            sentence_silence: float = 0.0,
+            cancel_token: Optional[CancelToken] = None
+    ):
+        """Synthesize WAV audio from pre-phonemized sentences, see synthesize_phonemes_stream_raw."""
+        self._set_wav_format(wav_file)
+        for audio_bytes in self.synthesize_phonemes_stream_raw(
+                sentences,
+                speaker_id=speaker_id,
+                length_scale=length_scale,
+                noise_scale=noise_scale,
+                noise_w=noise_w,
+                sentence_silence=sentence_silence,
+                cancel_token=cancel_token
+        ):
+            wav_file.writeframes(audio_bytes)
+
+    def synthesize_phonemes_stream_raw(
+            self,
+            sentences: Sequence[PhonemeInput],
+            speaker_id: Optional[int] = None,
+            length_scale: Optional[float] = None,
+            noise_scale: Optional[float] = None,
+            noise_w: Optional[float] = None,
+            sentence_silence: float = 0.0,
+            cancel_token: Optional[CancelToken] = None
+    ) -> Iterable[bytes]:
+        """Synthesize raw audio per sentence from pre-phonemized input, the phonemizer is not used.
+
+        Every sentence is an IPA string, a list of phonemes or a list of phoneme ids (see sentence_to_ids),
+        all sentences are validated against phoneme_id_map before any audio is synthesized.
+
+        Raises ValueError for phonemes or ids not supported by this voice."""
+        sentence_ids = [self.sentence_to_ids(sentence) for sentence in sentences]
+        yield from self._synthesize_sentences(
+            sentence_ids,
+            speaker_id=speaker_id,
+            length_scale=length_scale,
+            noise_scale=noise_scale,
+            noise_w=noise_w,
+            sentence_silence=sentence_silence,
+            cancel_token=cancel_token
+        )
+
+    def _set_wav_format(self, wav_file: wave.Wave_write):
+        wav_file.setframerate(self.config.sample_rate)
+        wav_file.setsampwidth(2)  # 16-bit
+        wav_file.setnchannels(1)  # mono
+
+    def _synthesize_sentences(
+            self,
+            sentence_ids: Iterable[List[int]],
+            speaker_id: Optional[int] = None,
+            length_scale: Optional[float] = None,
+            noise_scale: Optional[float] = None,
+            noise_w: Optional[float] = None,
+            sentence_silence: float = 0.0,
+            cancel_token: Optional[CancelToken] = None
+    ) -> Iterable[bytes]:
         # 16-bit mono
         num_silence_samples = int(sentence_silence * self.config.sample_rate)
         silence_bytes = bytes(num_silence_samples * 2)
 
-        for phonemes in sentence_phonemes:
-            phoneme_ids = self.phonemes_to_ids(phonemes)
+        # sentences produced lazily are counted one at a time
+        total = len(sentence_ids) if isinstance(sentence_ids, Sized) else None
+        for idx, phoneme_ids in enumerate(sentence_ids):
+            if cancel_token is not None:
+                cancel_token.check("sentences", total - idx if total is not None else 1)
+            if self.decoder is not None:
+                # audio per decoded window, the first one does not wait for the whole sentence
+                yield from self.synthesize_ids_stream_raw(
+                    phoneme_ids,
+                    speaker_id=speaker_id,
+                    length_scale=length_scale,
+                    noise_scale=noise_scale,
+                    noise_w=noise_w,
+                )
+                if silence_bytes:
+                    yield silence_bytes
+                continue
             yield self.synthesize_ids_to_raw(
                 phoneme_ids,
                 speaker_id=speaker_id,
@@ -213,6 +759,77 @@ class PiperVoice:
             noise_w: Optional[float] = None,
     ) -> bytes:
         """Synthesize raw audio from phoneme ids."""
+        if self.decoder is not None:
+            return b"".join(self.synthesize_ids_stream_raw(phoneme_ids,
+                                                           speaker_id=speaker_id,
+                                                           length_scale=length_scale,
+                                                           noise_scale=noise_scale,
+                                                           noise_w=noise_w))
+
+        speaker_id, length_scale, noise_scale, noise_w = self._resolve_params(speaker_id, length_scale,
+                                                                              noise_scale, noise_w)
+        if self.io_binding is not None:
+            audio = self.io_binding.run(phoneme_ids,
+                                        noise_scale=noise_scale,
+                                        length_scale=length_scale,
+                                        noise_w=noise_w,
+                                        speaker_id=speaker_id).squeeze((0, 1))
+            audio = audio_float_to_int16(audio.squeeze())
+            return audio.tobytes()
+
+        args = self._model_inputs(phoneme_ids, speaker_id, length_scale, noise_scale, noise_w)
+
+        # Synthesize through Onnx
+        audio = self.session.run(None, args, )[0].squeeze((0, 1))
+        audio = audio_float_to_int16(audio.squeeze())
+        return audio.tobytes()
+
+    def synthesize_ids_stream_raw(
+            self,
+            phoneme_ids: List[int],
+            speaker_id: Optional[int] = None,
+            length_scale: Optional[float] = None,
+            noise_scale: Optional[float] = None,
+            noise_w: Optional[float] = None,
+            window_frames: int = DECODER_WINDOW_FRAMES,
+            window_padding: int = DECODER_WINDOW_PADDING
+    ) -> Iterable[bytes]:
+        """Synthesize raw audio from phoneme ids, one window of latent frames at a time.
+
+        The encoder runs once for the sentence, the decoder then runs on overlapping windows,
+        the padding decoded around every window is dropped. Models without a separate decoder
+        yield the whole sentence at once."""
+        if self.decoder is None:
+            yield self.synthesize_ids_to_raw(phoneme_ids,
+                                             speaker_id=speaker_id,
+                                             length_scale=length_scale,
+                                             noise_scale=noise_scale,
+                                             noise_w=noise_w)
+            return
+
+        speaker_id, length_scale, noise_scale, noise_w = self._resolve_params(speaker_id, length_scale,
+                                                                              noise_scale, noise_w)
+        args = self._model_inputs(phoneme_ids, speaker_id, length_scale, noise_scale, noise_w)
+        encoded = dict(zip([o.name for o in self.session.get_outputs()], self.session.run(None, args)))
+        z, y_mask = encoded["z"], encoded["y_mask"]
+        # speaker embedding and anything else the decoder takes as is
+        extra = {i.name: encoded[i.name] for i in self.decoder.get_inputs()
+                 if i.name not in ("z", "y_mask") and i.name in encoded}
+
+        num_frames = z.shape[2]
+        for start in range(0, num_frames, window_frames):
+            end = min(start + window_frames, num_frames)
+            ctx_start, ctx_end = max(start - window_padding, 0), min(end + window_padding, num_frames)
+            audio = self.decoder.run(None, {"z": z[:, :, ctx_start:ctx_end],
+                                            "y_mask": y_mask[:, :, ctx_start:ctx_end],
+                                            **extra})[0].squeeze()
+            samples_per_frame = audio.shape[-1] // (ctx_end - ctx_start)
+            audio = audio[(start - ctx_start) * samples_per_frame:(end - ctx_start) * samples_per_frame]
+            yield audio_float_to_int16(audio, normalize=False).tobytes()
+
+    def _resolve_params(self, speaker_id: Optional[int], length_scale: Optional[float],
+                        noise_scale: Optional[float], noise_w: Optional[float]
+                        ) -> Tuple[Optional[int], float, float, float]:
         if length_scale is None:
             length_scale = self.config.length_scale
 
@@ -222,6 +839,17 @@ class PiperVoice:
         if noise_w is None:
             noise_w = self.config.noise_w
 
+        if self.config.num_speakers <= 1:
+            speaker_id = None
+
+        if (self.config.num_speakers > 1) and (speaker_id is None):
+            # Default speaker
+            speaker_id = 0
+        return speaker_id, length_scale, noise_scale, noise_w
+
+    @staticmethod
+    def _model_inputs(phoneme_ids: List[int], speaker_id: Optional[int],
+                      length_scale: float, noise_scale: float, noise_w: float) -> Dict[str, np.ndarray]:
         phoneme_ids_array = np.expand_dims(np.array(phoneme_ids, dtype=np.int64), 0)
         phoneme_ids_lengths = np.array([phoneme_ids_array.shape[1]], dtype=np.int64)
         scales = np.array(
@@ -235,19 +863,8 @@ class PiperVoice:
             "scales": scales
         }
 
-        if self.config.num_speakers <= 1:
-            speaker_id = None
-
-        if (self.config.num_speakers > 1) and (speaker_id is None):
-            # Default speaker
-            speaker_id = 0
-
         if speaker_id is not None:
             sid = np.array([speaker_id], dtype=np.int64)
             args["sid"] = sid  # <- this is the bug fix, upstream passes "sid": None to args
             # which crashes single speaker models
-
-        # Synthesize through Onnx
-        audio = self.session.run(None, args, )[0].squeeze((0, 1))
-        audio = audio_float_to_int16(audio.squeeze())
-        return audio.tobytes()
+        return args
@@ -0,0 +1,169 @@
+"""Priority scheduling of synthesis jobs
+
+Jobs are synthesized one sentence at a time, after every sentence the job goes back in line,
+a short interactive reply submitted while a long article is being read jumps ahead
+of the remaining sentences instead of waiting for the whole article.
+
+    scheduler = SynthesisScheduler()
+    job = scheduler.submit(engine, "Timer set", priority=Priority.INTERACTIVE)
+    for audio_bytes in job:
+        ...
+    job.cancel()  # stop at the next sentence boundary
+"""
+import heapq
+import itertools
+import queue
+import threading
+import time
+from enum import IntEnum
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from ovos_tts_plugin_piper.cancel import CancelToken, SynthesisCancelled
+from ovos_tts_plugin_piper.piper import PiperVoice
+from ovos_utils.log import LOG
+
+
+class Priority(IntEnum):
+    """lower values are synthesized first"""
+    INTERACTIVE = 0
+    NORMAL = 1
+    LONG_FORM = 2
+
+
+class SynthesisJob:
+    def __init__(self, engine: PiperVoice, text: str,
+                 priority: Priority = Priority.NORMAL,
+                 callback: Optional[Callable[["SynthesisJob", Optional[bytes]], None]] = None,
+                 cancel_token: Optional[CancelToken] = None,
+                 **synth_kwargs):
+        """
+        Args:
+            engine: voice used to synthesize the text
+            text: text to synthesize
+            priority: scheduling class of the job
+            callback: called from the worker thread with (job, audio chunk), and with (job, None) when the job ends
+            cancel_token: optional token carrying a deadline, one is created if not given
+            synth_kwargs: extra arguments for PiperVoice.synthesize_stream_raw
+        """
+        self.engine = engine
+        self.callback = callback
+        self.text = text
+        self.priority = Priority(priority)
+        self.synth_kwargs = synth_kwargs
+        self.chunks: "queue.Queue[Any]" = queue.Queue()
+        self.error: Optional[Exception] = None
+        self.metrics: Dict[str, float] = {"submitted": time.monotonic()}
+        self.cancel_token = cancel_token or CancelToken()
+        self._stream: Optional[Iterator[bytes]] = None
+        self._done = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self):
+        """stop synthesizing at the next sentence boundary"""
+        self.cancel_token.cancel()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def step(self) -> bool:
+        """synthesize the next sentence, returns False once the job is finished"""
+        try:
+            if self._stream is None:
+                self._stream = iter(self.engine.synthesize_stream_raw(self.text,
+                                                                      cancel_token=self.cancel_token,
+                                                                      **self.synth_kwargs))
+            audio = next(self._stream)
+        except (StopIteration, SynthesisCancelled):
+            self._finish()
+            return False
+        except Exception as e:
+            LOG.error(f"piper synthesis failed: {e}")
+            self.error = e
+            self._finish()
+            return False
+        if "first_audio" not in self.metrics:
+            self.metrics["first_audio"] = time.monotonic() - self.metrics["submitted"]
+        self._emit(audio)
+        return True
+
+    def _emit(self, audio: Optional[bytes]):
+        self.chunks.put(audio)
+        if self.callback is not None:
+            self.callback(self, audio)
+
+    def _finish(self):
+        self.metrics["total"] = time.monotonic() - self.metrics["submitted"]
+        self._done.set()
+        self._emit(None)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            audio = self.chunks.get()
+            if audio is None:
+                break
+            yield audio
+        if self.error is not None:
+            raise self.error
+
+
+class SynthesisScheduler:
+    def __init__(self, workers: int = 1):
+        """
+        Args:
+            workers: number of sentences synthesized at the same time
+        """
+        self._heap: List[Tuple[int, int, SynthesisJob]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, engine: PiperVoice, text: str,
+               priority: Priority = Priority.NORMAL,
+               callback: Optional[Callable[["SynthesisJob", Optional[bytes]], None]] = None,
+               cancel_token: Optional[CancelToken] = None,
+               **synth_kwargs) -> SynthesisJob:
+        """queue text for synthesis, iterate the returned job (or pass a callback) to receive audio per sentence"""
+        job = SynthesisJob(engine, text, priority, callback, cancel_token, **synth_kwargs)
+        self._push(job)
+        return job
+
+    def _push(self, job: SynthesisJob):
+        with self._cond:
+            # sequence number keeps FIFO order inside a priority class,
+            # requeued jobs go behind jobs of the same class that are already waiting
+            heapq.heappush(self._heap, (job.priority, next(self._seq), job))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+            if job.step():
+                self._push(job)
+
+    def shutdown(self):
+        """stop the workers, pending jobs are cancelled"""
+        with self._cond:
+            self._running = False
+            pending = [job for _, _, job in self._heap]
+            self._heap.clear()
+            self._cond.notify_all()
+        for job in pending:
+            job.cancel()
+            job.step()
+        for t in self._threads:
+            t.join()
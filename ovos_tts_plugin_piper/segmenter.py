@@ -0,0 +1,175 @@
+"""Single pass text segmentation into clauses
+
+Sentence boundaries and clause delimiters are found by one precompiled regex in a single scan of the text,
+producing the same chunks as splitting into sentences with quebra_frases and then splitting every sentence
+on the clause delimiters.
+
+Text can also be fed incrementally, eg. tokens of a streaming LLM reply,
+clauses are emitted as soon as their delimiter arrives
+
+    segmenter = TextSegmenter(get_segmenter_rules("en-us"))
+    for token in tokens:
+        for chunk, punct, end_of_sentence in segmenter.feed(token):
+            ...
+    remaining = segmenter.flush()
+"""
+import re
+import string
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# list of (substring, terminator, end_of_sentence) tuples.
+TextChunks = List[Tuple[str, str, bool]]
+
+DEFAULT_DELIMITERS = (", ", ":", ";", "...", "|")
+# same rule as quebra_frases.sentence_tokenize, whitespace after "." or "?" unless it ends an abbreviation
+DEFAULT_SENTENCE_BOUNDARY = r"(?<=[.?])(?<!\w\.\w.)(?<![A-Z][a-z]\.)\s"
+
+# lookbehind context kept around when consumed text is dropped from the buffer
+_CONTEXT = 8
+
+
+@dataclass(frozen=True)
+class SegmenterRules:
+    delimiters: Tuple[str, ...] = DEFAULT_DELIMITERS
+    """clause delimiters, tried in order at every position"""
+    sentence_boundary: str = DEFAULT_SENTENCE_BOUNDARY
+    """regex matching the separator between two sentences, the match is dropped"""
+    punctuation: str = string.punctuation
+    """a sentence ending in one of these characters keeps it as terminator, otherwise "." is used"""
+    boundary_start: Optional[str] = r"\s"
+    """regex character class content matching the first character of every sentence_boundary match,
+    lets the scan skip other positions quickly, None for zero width boundaries"""
+
+
+DEFAULT_RULES = SegmenterRules()
+
+_ARABIC_RULES = SegmenterRules(delimiters=DEFAULT_DELIMITERS + ("، ", "؛"),
+                               sentence_boundary=r"(?<=[.?؟!])\s",
+                               punctuation=string.punctuation + "،؛؟")
+_CHINESE_RULES = SegmenterRules(delimiters=DEFAULT_DELIMITERS + ("，", "、", "；", "："),
+                                sentence_boundary=r"(?<=[。！？])|" + DEFAULT_SENTENCE_BOUNDARY,
+                                punctuation=string.punctuation + "。！？，、；：",
+                                boundary_start=None)
+_JAPANESE_RULES = SegmenterRules(delimiters=DEFAULT_DELIMITERS + ("、", "，"),
+                                 sentence_boundary=r"(?<=[。！？])|" + DEFAULT_SENTENCE_BOUNDARY,
+                                 punctuation=string.punctuation + "。！？、，",
+                                 boundary_start=None)
+
+# lang -> rules, lookup by exact lang and then by base language,
+# keys include the espeak voices of the languages, the phonemizer passes those
+LANG_RULES: Dict[str, SegmenterRules] = {
+    "ar": _ARABIC_RULES,
+    "fa": _ARABIC_RULES,
+    "zh": _CHINESE_RULES,
+    "cmn": _CHINESE_RULES,
+    "yue": _CHINESE_RULES,
+    "hak": _CHINESE_RULES,
+    "ja": _JAPANESE_RULES,
+}
+
+
+def register_segmenter_rules(lang: str, rules: SegmenterRules):
+    LANG_RULES[lang.lower()] = rules
+    get_segmenter_rules.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def get_segmenter_rules(lang: Optional[str] = None) -> SegmenterRules:
+    if not lang:
+        return DEFAULT_RULES
+    lang = lang.lower()
+    return LANG_RULES.get(lang) or LANG_RULES.get(lang.split("-")[0]) or DEFAULT_RULES
+
+
+@lru_cache(maxsize=64)
+def _punctuation_pattern(punctuation: str) -> "re.Pattern":
+    return re.compile("[" + re.escape(punctuation) + "]")
+
+
+def remove_punctuation(text: str, lang: Optional[str] = None) -> str:
+    """text without the punctuation characters of the language's rules"""
+    return _punctuation_pattern(get_segmenter_rules(lang).punctuation).sub("", text).strip()
+
+
+@lru_cache(maxsize=64)
+def _compile(rules: SegmenterRules) -> "re.Pattern":
+    delimiters = "|".join(re.escape(d) for d in rules.delimiters)
+    pattern = f"(?P<sentence>{rules.sentence_boundary})|(?P<delimiter>{delimiters})"
+    if rules.boundary_start is not None:
+        # only try the alternatives where a match can start
+        first_chars = "".join(sorted({re.escape(d[0]) for d in rules.delimiters}))
+        pattern = f"(?=[{rules.boundary_start}{first_chars}])(?:{pattern})"
+    return re.compile(pattern)
+
+
+class TextSegmenter:
+    def __init__(self, rules: SegmenterRules = DEFAULT_RULES):
+        self.rules = rules
+        self._pattern = _compile(rules)
+        self._buffer = ""
+        self._pos = 0  # start of the pending clause
+        self._sentence_start = 0
+        self._zero_width_end = False  # last chunk ended a sentence at a zero width boundary
+
+    def _terminator(self, sentence_end: int) -> str:
+        # the sentence as quebra_frases would return it, only its last character matters
+        if sentence_end > self._sentence_start and self._buffer[sentence_end - 1] in self.rules.punctuation:
+            return self._buffer[sentence_end - 1]
+        return "."
+
+    def _scan(self) -> TextChunks:
+        chunks: TextChunks = []
+        for match in self._pattern.finditer(self._buffer, self._pos):
+            if match.start() == match.end() == self._sentence_start:
+                continue  # zero width boundary already consumed by a previous scan
+            clause = self._buffer[self._pos:match.start()].strip()
+            if match.lastgroup == "delimiter":
+                chunks.append((clause, match.group().strip(), False))
+            else:
+                chunks.append((clause, self._terminator(match.start()), True))
+                self._sentence_start = match.end()
+            self._zero_width_end = match.start() == match.end()
+            self._pos = match.end()
+        # drop consumed text, keeping enough context for lookbehinds
+        drop = max(self._pos - _CONTEXT, 0)
+        if drop:
+            self._buffer = self._buffer[drop:]
+            self._pos -= drop
+            self._sentence_start -= drop
+        return chunks
+
+    def feed(self, text: str) -> TextChunks:
+        """add text, returns the clauses completed by it"""
+        self._buffer += text
+        return self._scan()
+
+    def flush(self) -> TextChunks:
+        """end of text, returns the remaining clauses, the last one always ends the last sentence"""
+        chunks = self._scan()
+        remaining = self._buffer[self._pos:].strip()
+        # a sentence closed by a zero width boundary (eg. after 。) does not leave an empty one behind
+        if remaining or not self._zero_width_end:
+            chunks.append((remaining, self._terminator(len(self._buffer)), True))
+        self._reset()
+        return chunks
+
+    def _reset(self):
+        self._buffer, self._pos, self._sentence_start = "", 0, 0
+        self._zero_width_end = False
+
+    def segment(self, text: str) -> TextChunks:
+        """split a complete text into clauses"""
+        if not text:
+            return [("", "", True)]
+        self._reset()
+        return self.feed(text) + self.flush()
+
+
+def segment_text(text: str, lang: Optional[str] = None,
+                 delimiters: Optional[Sequence[str]] = None) -> TextChunks:
+    rules = get_segmenter_rules(lang)
+    if delimiters:
+        rules = SegmenterRules(tuple(delimiters), rules.sentence_boundary, rules.punctuation, rules.boundary_start)
+    return TextSegmenter(rules).segment(text)
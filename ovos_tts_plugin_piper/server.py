@@ -0,0 +1,319 @@
+"""Standalone piper TTS server
+
+One warm process serving every client on the host instead of each client loading its own models.
+Speaks a wyoming-like protocol over TCP or a unix socket,
+every message is a JSON header line optionally followed by `payload_length` bytes of payload
+
+    -> {"type": "synthesize", "data": {"text": "hello world", "voice": "alan-low", "lang": "en-GB", "speaker": 0,
+                                       "priority": 0, "timeout": 5.0}}
+    <- {"type": "audio-start", "data": {"rate": 22050, "width": 2, "channels": 1, "voice": "en_GB-alan-low"}}
+    <- {"type": "audio-chunk", "data": {"rate": 22050, "width": 2, "channels": 1}, "payload_length": 1234}
+    <- <1234 bytes of 16-bit mono PCM>
+    <- {"type": "audio-stop"}
+
+    -> {"type": "cancel"}  # stops every pending request of the connection at the next sentence
+
+requests past their "timeout" (seconds) are abandoned the same way, the response then ends
+with audio-stop after the audio synthesized so far
+
+    -> {"type": "describe"}
+    <- {"type": "info", "data": {"languages": [...], "loaded_voices": [...], "cancelled_work": {...}}}
+
+    -> {"type": "load", "data": {"voice": "alan-low", "lang": "en-GB"}}  # warm a voice before requests arrive
+    <- {"type": "loaded", "data": {"voice": "en_GB-alan-low"}}
+    -> {"type": "unload", "data": {"voice": "en_GB-alan-low"}}  # drop a loaded voice, eg. after rebalancing
+    <- {"type": "unloaded", "data": {"voice": "en_GB-alan-low"}}
+
+failures are reported as {"type": "error", "data": {"text": "..."}}
+
+Voices of incoming requests are resolved concurrently, a request waiting for its voice to be
+downloaded or loaded does not hold back requests for voices that are already loaded.
+Sentences of concurrent requests are interleaved so every client gets its first audio chunk after
+a single sentence, and scheduled by priority (see scheduler.Priority), interactive requests jump
+ahead of the remaining sentences of long-form requests.
+"""
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from ovos_tts_plugin_piper import PiperTTSPlugin
+from ovos_tts_plugin_piper.cancel import CancelToken, CANCELLED_WORK
+from ovos_tts_plugin_piper.piper import PiperVoice
+from ovos_tts_plugin_piper.scheduler import Priority, SynthesisJob, SynthesisScheduler
+from ovos_utils.log import LOG
+
+
+@dataclass
+class SynthesisRequest:
+    text: str
+    lang: Optional[str] = None
+    voice: Optional[str] = None
+    speaker: Optional[int] = None
+    priority: Priority = Priority.NORMAL
+    # resolved before the request is submitted to the scheduler
+    engine: Optional[PiperVoice] = None
+    voice_key: Optional[str] = None
+    phonemizer_lang: Optional[str] = None
+    # (header, payload) messages for the client, None after the last one
+    events: asyncio.Queue = field(default_factory=asyncio.Queue)
+    job: Optional[SynthesisJob] = None
+    cancel_token: CancelToken = field(default_factory=CancelToken)
+
+    @property
+    def closed(self) -> bool:
+        """request was cancelled, ran past its deadline or the client went away"""
+        return self.cancel_token.cancelled
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+
+class PiperTTSServer:
+    def __init__(self, plugin: PiperTTSPlugin,
+                 workers: int = 1,
+                 load_workers: int = 4):
+        """
+        Args:
+            plugin: plugin instance used to select and load voices
+            workers: number of sentences synthesized at the same time
+            load_workers: number of voices downloaded or loaded at the same time
+        """
+        self.plugin = plugin
+        self.workers = workers
+        self.scheduler = SynthesisScheduler(workers)
+        self._executor = ThreadPoolExecutor(max_workers=load_workers)
+        # (lang, voice) -> lock, requests for the same voice wait for a single load
+        self._voice_locks: Dict[Tuple[Optional[str], Optional[str]], asyncio.Lock] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # protocol
+    @staticmethod
+    async def read_event(reader: asyncio.StreamReader) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        header = json.loads(line)
+        payload = b""
+        if header.get("payload_length"):
+            payload = await reader.readexactly(header["payload_length"])
+        return header, payload
+
+    @staticmethod
+    def write_event(writer: asyncio.StreamWriter, event_type: str,
+                    data: Optional[Dict[str, Any]] = None, payload: bytes = b""):
+        header: Dict[str, Any] = {"type": event_type}
+        if data is not None:
+            header["data"] = data
+        if payload:
+            header["payload_length"] = len(payload)
+        writer.write(json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n")
+        if payload:
+            writer.write(payload)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        pending: List[SynthesisRequest] = []
+        previous: Optional[asyncio.Task] = None
+        try:
+            while True:
+                event = await self.read_event(reader)
+                if event is None:
+                    break
+                header, _ = event
+                data = header.get("data") or {}
+                if header.get("type") == "describe":
+                    self.write_event(writer, "info", {
+                        "languages": sorted(self.plugin.available_languages),
+                        "loaded_voices": list(PiperTTSPlugin.engines),
+                        "cancelled_work": dict(CANCELLED_WORK)
+                    })
+                elif header.get("type") == "synthesize":
+                    request = SynthesisRequest(text=data.get("text", ""),
+                                               lang=data.get("lang"),
+                                               voice=data.get("voice"),
+                                               speaker=data.get("speaker"),
+                                               cancel_token=CancelToken(timeout=data.get("timeout")))
+                    pending.append(request)
+                    try:
+                        request.priority = Priority(data.get("priority", Priority.NORMAL))
+                    except ValueError:
+                        # answered in order, after the responses already streaming on this connection
+                        request.events.put_nowait((("error", {
+                            "text": f"invalid priority: {data.get('priority')!r}, "
+                                    f"expected one of {[int(p) for p in Priority]}"}), b""))
+                        request.events.put_nowait(None)
+                    else:
+                        if self.plugin.quality_router is not None:
+                            self.plugin.quality_router.request_started()
+                        self._create_task(self._start(request))
+                    # keep reading so a cancel can arrive while audio is streaming
+                    previous = asyncio.create_task(self._stream_response(request, writer, previous, pending))
+                elif header.get("type") == "cancel":
+                    for request in pending:
+                        request.cancel()
+                elif header.get("type") == "load":
+                    try:
+                        _, _, voice, _ = await self._get_engine(data.get("lang"), data.get("voice"), preload=True)
+                        self.write_event(writer, "loaded", {"voice": voice})
+                    except Exception as e:
+                        LOG.error(f"Failed to load piper voice: {e}")
+                        self.write_event(writer, "error", {"text": str(e)})
+                elif header.get("type") == "unload":
+                    # requests already using the engine keep a reference to it until they finish
+                    PiperTTSPlugin.engines.pop(data.get("voice"), None)
+                    self.write_event(writer, "unloaded", {"voice": data.get("voice")})
+                else:
+                    self.write_event(writer, "error", {"text": f"unknown event type: {header.get('type')}"})
+                await writer.drain()
+            if previous is not None:
+                await previous
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            LOG.exception(f"piper server client error: {e}")
+        finally:
+            for request in pending:
+                request.cancel()
+            writer.close()
+
+    async def _stream_response(self, request: SynthesisRequest, writer: asyncio.StreamWriter,
+                               previous: Optional[asyncio.Task], pending: List[SynthesisRequest]):
+        """write the events of a request once the previous response of the connection is complete"""
+        try:
+            if previous is not None:
+                await previous
+            while True:
+                message = await request.events.get()
+                if message is None:
+                    break
+                (event_type, event_data), payload = message
+                self.write_event(writer, event_type, event_data, payload)
+                await writer.drain()
+        except ConnectionError:
+            request.cancel()
+        finally:
+            pending.remove(request)
+
+    # scheduling
+    def _create_task(self, coro) -> asyncio.Task:
+        # the event loop only keeps weak references to tasks
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _get_engine(self, lang: Optional[str] = None, voice: Optional[str] = None,
+                          speaker: Optional[int] = None, preload: bool = False):
+        """plugin.get_engine in a worker thread, voice lookup may need to download or load a model"""
+        lock = self._voice_locks.setdefault((lang, voice), asyncio.Lock())
+        async with lock:
+            return await self._loop.run_in_executor(self._executor, self.plugin.get_engine,
+                                                    lang, voice, speaker, preload)
+
+    async def _start(self, request: SynthesisRequest):
+        """resolve the voice of a request and hand it to the scheduler"""
+        try:
+            engine, speaker, voice, phonemizer_lang = await self._get_engine(request.lang, request.voice,
+                                                                             request.speaker)
+        except Exception as e:
+            LOG.error(f"Failed to select piper voice: {e}")
+            if self.plugin.quality_router is not None:
+                self.plugin.quality_router.request_finished()
+            self._emit(request, (("error", {"text": str(e)}), b""))
+            self._emit(request, None)
+            return
+        request.engine, request.speaker = engine, speaker
+        request.voice_key, request.phonemizer_lang = voice, phonemizer_lang
+        if request.closed:
+            if self.plugin.quality_router is not None:
+                self.plugin.quality_router.request_finished()
+            self._emit(request, None)
+            return
+        self._submit(request)
+
+    def _emit(self, request: SynthesisRequest, message):
+        self._loop.call_soon_threadsafe(request.events.put_nowait, message)
+
+    def _submit(self, request: SynthesisRequest):
+        audio_format = {"rate": request.engine.config.sample_rate, "width": 2, "channels": 1}
+        num_samples = 0
+
+        def on_audio(job: SynthesisJob, audio: Optional[bytes]):
+            # called from a scheduler thread
+            nonlocal num_samples
+            if audio is not None:
+                num_samples += len(audio) // 2
+                self._emit(request, (("audio-chunk", audio_format), audio))
+                return
+            if self.plugin.quality_router is not None:
+                self.plugin.quality_router.request_finished(request.voice_key,
+                                                            job.metrics["total"],
+                                                            num_samples / audio_format["rate"])
+            if job.error is not None:
+                self._emit(request, (("error", {"text": str(job.error)}), b""))
+            else:
+                self._emit(request, (("audio-stop", None), b""))
+            self._emit(request, None)
+
+        # report which voice (quality tier) serves the request
+        self._emit(request, (("audio-start", dict(audio_format, voice=request.voice_key)), b""))
+        request.job = self.scheduler.submit(request.engine, request.text,
+                                            priority=request.priority,
+                                            callback=on_audio,
+                                            cancel_token=request.cancel_token,
+                                            speaker_id=request.speaker,
+                                            length_scale=self.plugin.length_scale,
+                                            noise_scale=self.plugin.noise_scale,
+                                            noise_w=self.plugin.noise_w,
+                                            phonemizer_lang=request.phonemizer_lang)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 10200, uri: Optional[str] = None):
+        """Serve forever on a TCP host/port, or on a unix socket if uri is set"""
+        self._loop = asyncio.get_running_loop()
+        if uri:
+            server = await asyncio.start_unix_server(self.handle_client, path=uri)
+            LOG.info(f"piper server listening on unix://{uri}")
+        else:
+            server = await asyncio.start_server(self.handle_client, host=host, port=port)
+            LOG.info(f"piper server listening on tcp://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.scheduler.shutdown()
+            self._executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="piper TTS server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=10200)
+    parser.add_argument("--uri", help="unix socket path, used instead of host/port")
+    parser.add_argument("--config", help="path to a json file with the plugin config")
+    parser.add_argument("--lang", default="en-US")
+    parser.add_argument("--voice", default="default")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of sentences synthesized at the same time")
+    parser.add_argument("--load-workers", type=int, default=4,
+                        help="number of voices downloaded or loaded at the same time")
+    args = parser.parse_args()
+
+    config = {"lang": args.lang, "voice": args.voice}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config.update(json.load(f))
+
+    server = PiperTTSServer(PiperTTSPlugin(config),
+                            workers=args.workers,
+                            load_workers=args.load_workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.uri))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Push based synthesis of text that arrives in pieces, eg. a LLM reply streamed token by token
+
+Text is split into clauses as it arrives, every completed clause is phonemized and synthesized
+in a background thread while the caller keeps feeding text, so the first audio is ready one clause
+after the first token instead of after the whole reply
+
+    session = StreamingSession(engine)
+    for token in llm_tokens:
+        session.feed(token)
+    session.close()  # no more text, the last clause is synthesized
+    for audio_bytes in session:  # 16-bit mono PCM at session.sample_rate, usually consumed in another thread
+        ...
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from ovos_tts_plugin_piper.cancel import CancelToken, SynthesisCancelled
+from ovos_tts_plugin_piper.piper import PiperVoice
+from ovos_tts_plugin_piper.segmenter import TextSegmenter, get_segmenter_rules
+from ovos_utils.log import LOG
+
+
+class StreamingSession:
+    def __init__(self, engine: PiperVoice,
+                 speaker_id: Optional[int] = None,
+                 length_scale: Optional[float] = None,
+                 noise_scale: Optional[float] = None,
+                 noise_w: Optional[float] = None,
+                 phonemizer_lang: Optional[str] = None,
+                 cancel_token: Optional[CancelToken] = None,
+                 on_finish: Optional[Callable[["StreamingSession"], None]] = None):
+        """
+        Args:
+            engine: voice used to synthesize the text
+            speaker_id, length_scale, noise_scale, noise_w, phonemizer_lang: see PiperVoice.synthesize_stream_raw
+            cancel_token: optional token carrying a deadline, one is created if not given
+            on_finish: called from the synthesis thread once all audio was produced, or synthesis stopped
+        """
+        self.engine = engine
+        self.synth_kwargs: Dict[str, Any] = dict(speaker_id=speaker_id,
+                                                 length_scale=length_scale,
+                                                 noise_scale=noise_scale,
+                                                 noise_w=noise_w,
+                                                 phonemizer_lang=phonemizer_lang)
+        self.cancel_token = cancel_token or CancelToken()
+        self.on_finish = on_finish
+        self.error: Optional[Exception] = None
+        self.metrics: Dict[str, float] = {}
+        """first_text (time.monotonic() of the first text), first_audio (seconds from first text to first audio),
+        clauses (synthesized so far)"""
+        self._segmenter = TextSegmenter(get_segmenter_rules(phonemizer_lang or engine.config.espeak_voice))
+        self._clauses: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._audio: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._lock = threading.Lock()  # feed/close may be called from different threads
+        self._closed = False
+        self._done = threading.Event()
+        # a cancelled token wakes the synthesis thread up if it is waiting for text
+        self.cancel_token.on_cancel(lambda: self._clauses.put(None))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def sample_rate(self) -> int:
+        return self.engine.config.sample_rate
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def feed(self, text: str):
+        """add text, clauses completed by it start synthesizing right away"""
+        with self._lock:
+            if self._closed:
+                if self.cancel_token.cancelled:
+                    return  # the reply was interrupted, the rest of the text is dropped
+                raise RuntimeError("text fed to a closed streaming session")
+            if "first_text" not in self.metrics:
+                self.metrics["first_text"] = time.monotonic()
+            for clause, _, _ in self._segmenter.feed(text):
+                self._push(clause)
+
+    def close(self):
+        """end of text, the remaining text is synthesized as the last clause"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for clause, _, _ in self._segmenter.flush():
+                self._push(clause)
+            self._clauses.put(None)
+
+    def cancel(self):
+        """stop synthesizing at the next clause, no more audio is produced"""
+        self.cancel_token.cancel()
+        self.close()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def _push(self, clause: str):
+        if clause:  # clauses without text have nothing to say
+            self._clauses.put(clause)
+
+    def _run(self):
+        try:
+            while True:
+                clause = self._clauses.get()
+                if clause is None:
+                    break
+                # terminators are not pronounced, the clause is synthesized as its own sentence
+                for audio in self.engine.synthesize_stream_raw(clause, cancel_token=self.cancel_token,
+                                                               **self.synth_kwargs):
+                    if "first_audio" not in self.metrics:
+                        self.metrics["first_audio"] = time.monotonic() - self.metrics["first_text"]
+                    self._audio.put(audio)
+                self.metrics["clauses"] = self.metrics.get("clauses", 0) + 1
+            # cancelled while waiting for text
+            self.cancel_token.check("sentences", 0)
+        except SynthesisCancelled as e:
+            self.error = e
+        except Exception as e:
+            LOG.error(f"piper streaming synthesis failed: {e}")
+            self.error = e
+        self._done.set()
+        self._audio.put(None)
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def __iter__(self) -> Iterator[bytes]:
+        """PCM per clause, raises SynthesisCancelled if the session was cancelled before all text was spoken"""
+        while True:
+            audio = self._audio.get()
+            if audio is None:
+                break
+            yield audio
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self) -> "StreamingSession":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.cancel()
+        else:
+            self.close()
@@ -0,0 +1,84 @@
+"""Arabic diacritization (tashkeel) front-end stage
+
+Arabic text is usually written without short vowels, espeak needs them to pronounce it correctly.
+https://github.com/mush42/libtashkeel/ restores them, the model is loaded once per process
+and kept warm, text is diacritized one chunk at a time, right before the chunk is phonemized,
+so the first sentence is synthesized before the rest of the text is diacritized, and results are cached per chunk.
+"""
+import threading
+import time
+from functools import lru_cache
+from typing import Dict
+
+from ovos_utils.log import LOG
+
+
+class TashkeelDiacritizer:
+    def __init__(self, cache_size: int = 1024):
+        """
+        Args:
+            cache_size: number of diacritized chunks kept in memory
+        """
+        self._tashkeel_run = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._cached_run = lru_cache(maxsize=cache_size)(self._run)
+        self.metrics: Dict[str, float] = {"calls": 0, "cache_hits": 0, "total_time": 0.0, "last_time": 0.0}
+
+    @property
+    def available(self) -> bool:
+        return self.load()
+
+    def load(self) -> bool:
+        """import piper-phonemize and load the model once, returns False if it is not installed"""
+        if self._loaded:
+            return self._tashkeel_run is not None
+        with self._lock:
+            if not self._loaded:
+                start = time.monotonic()
+                try:
+                    from piper_phonemize import tashkeel_run
+                    tashkeel_run("")  # the model is loaded on first use
+                    self._tashkeel_run = tashkeel_run
+                    self.metrics["load_time"] = time.monotonic() - start
+                except ImportError:
+                    LOG.error("Failed to load tashkeel diacritizer, is piper-phonemize installed?")
+                except Exception as e:
+                    LOG.error(f"Failed to load tashkeel diacritizer: {e}")
+                self._loaded = True
+        return self._tashkeel_run is not None
+
+    def warmup(self):
+        """load the model and run it once, so the first request does not pay for it"""
+        if self.load():
+            try:
+                self._run("مرحبا")
+            except Exception as e:
+                LOG.warning(f"tashkeel diacritizer warm-up failed: {e}")
+
+    def _run(self, text: str) -> str:
+        # errors propagate, so failures are not cached
+        return self._tashkeel_run(text)
+
+    def __call__(self, text: str) -> str:
+        """diacritized text, or the text unchanged if the diacritizer is unavailable or fails"""
+        if not text.strip() or not self.load():
+            return text
+        start = time.monotonic()
+        try:
+            text = self._cached_run(text)
+        except Exception as e:
+            LOG.warning(f"tashkeel diacritizer failed, using text as is: {e}")
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.metrics["calls"] += 1
+            self.metrics["cache_hits"] = self._cached_run.cache_info().hits
+            self.metrics["total_time"] += elapsed
+            self.metrics["last_time"] = elapsed
+        return text
+
+
+@lru_cache(maxsize=1)
+def get_diacritizer() -> TashkeelDiacritizer:
+    """process wide diacritizer, piper-phonemize keeps a single model loaded"""
+    return TashkeelDiacritizer()
@@ -1,10 +1,13 @@
 """Utility for downloading Piper voices."""
 import hashlib
 import json
+import os
 import shutil
+import threading
 from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, Set, Tuple, Union, List
+from typing import Any, Dict, Optional, Set, Tuple, Union, List
 from urllib.parse import quote
 from urllib.request import urlopen
 
@@ -21,6 +24,8 @@ _SKIP_FILES = {"MODEL_CARD"}
 LANG2VOICES = defaultdict(list)
 SHORTNAMES = {}
 LOCALMODELS = {}
+QUALITY_TIERS = ["x_low", "low", "medium", "high"]  # fastest first
+_CATALOG_LOCK = threading.Lock()  # voices may be resolved from several threads, eg. by the server
 
 
 class VoiceNotFoundError(FileNotFoundError):
@@ -44,25 +49,36 @@ def get_available_voices(update_voices: bool = True) -> Dict[str, Any]:
     download_dir = Path(DATA_DIR)
     voices_download = download_dir / "voices.json"
 
-    if update_voices:
-        # Download latest voices.json
-        voices_url = VOICES_URL.format(file="voices.json")
-        LOG.debug("Downloading %s to %s", voices_url, voices_download)
-        try:
-            with urlopen(voices_url) as response, open(
-                    voices_download, "wb"
-            ) as download_file:
-                shutil.copyfileobj(response, download_file)
-        except Exception as e:
-            LOG.error(f"Failed to download {voices_url}: {e}")
-
-    # Prefer downloaded file to embedded
-    voices_embedded = _DIR / "voices.json"
-    voices_path = voices_download if voices_download.exists() else voices_embedded
-
-    LOG.debug("Loading %s", voices_path)
-    with open(voices_path, "r", encoding="utf-8") as voices_file:
-        return json.load(voices_file)
+    with _CATALOG_LOCK:
+        if update_voices:
+            # Download latest voices.json
+            voices_url = VOICES_URL.format(file="voices.json")
+            LOG.debug("Downloading %s to %s", voices_url, voices_download)
+            try:
+                _copy_url(voices_url, voices_download)
+            except Exception as e:
+                LOG.error(f"Failed to download {voices_url}: {e}")
+
+        # Prefer downloaded file to embedded
+        voices_embedded = _DIR / "voices.json"
+        voices_path = voices_download if voices_download.exists() else voices_embedded
+
+        LOG.debug("Loading %s", voices_path)
+        with open(voices_path, "r", encoding="utf-8") as voices_file:
+            return json.load(voices_file)
+
+
+def _copy_url(url: str, path: Path):
+    """download to a temporary file first, readers never see a partially written file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with urlopen(url) as response, open(tmp_path, "wb") as download_file:
+            shutil.copyfileobj(response, download_file)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
 
 
 def get_voice_files(name: str) -> Tuple[Path, Path]:
@@ -136,14 +152,10 @@ def get_voice_files(name: str) -> Tuple[Path, Path]:
 
 
 def _download_file(file_url, download_file_path: Path, file_name=None):
-    download_file_path.parent.mkdir(parents=True, exist_ok=True)
     file_name = file_name or download_file_path.name
     LOG.debug("Downloading %s to %s", file_url, download_file_path)
     try:
-        with urlopen(quote(file_url, safe=":/")) as response, open(
-                download_file_path, "wb"
-        ) as download_file:
-            shutil.copyfileobj(response, download_file)
+        _copy_url(quote(file_url, safe=":/"), download_file_path)
         LOG.info("Downloaded %s (%s)", download_file_path, file_url)
     except Exception as e:
         LOG.error(f"Failed to download {file_url}: {e}")
@@ -172,8 +184,34 @@ for voice, data in get_available_voices().items():
     SHORTNAMES[name] = voice
 
 
+@lru_cache(maxsize=256)
+def standardize_lang(lang: str) -> str:
+    return standardize_lang_tag(lang)
+
+
+@lru_cache(maxsize=256)
+def _resolve_lang_voices(lang: str) -> Tuple[Tuple[str, int], ...]:
+    """lang -> ((voice, distance), ...) sorted by distance
+
+    tag_distance is computed once per catalog language instead of once per voice,
+    results are cached until the catalog changes (see add_local_model)"""
+    voices = []
+    for k, v in LANG2VOICES.items():
+        dist = tag_distance(lang, k)
+        if dist < 10:
+            voices += [(SHORTNAMES.get(v2, v2), dist) for v2 in v]
+    return tuple(sorted(voices, key=lambda k: k[1]))
+
+
+def _invalidate_lang_index():
+    _resolve_lang_voices.cache_clear()
+    get_best_lang_code.cache_clear()
+    get_faster_voices.cache_clear()
+
+
+@lru_cache(maxsize=256)
 def get_best_lang_code(desired_lang):
-    desired_lang = standardize_lang_tag(desired_lang)
+    desired_lang = standardize_lang(desired_lang)
     lang, dist = closest_match(desired_lang, LANG2VOICES)
     if dist < 10:
         return lang
@@ -181,18 +219,59 @@ def get_best_lang_code(desired_lang):
 
 
 def get_lang_voices(lang: str) -> List[Tuple[str, int]]:
-    lang = standardize_lang_tag(lang)
-    voices = [(SHORTNAMES[v2], tag_distance(lang, k))
-              for k, v in LANG2VOICES.items()
-              for v2 in v
-              if tag_distance(lang, k) < 10]
+    voices = _resolve_lang_voices(standardize_lang(lang))
     if not voices:
         raise VoiceNotFoundError("Unsupported language")
-    return sorted(voices, key=lambda k: k[1])
+    return list(voices)
 
 
 def get_default_voice(lang: str) -> str:
-    return get_lang_voices(lang)[0][0]
+    voices = _resolve_lang_voices(standardize_lang(lang))
+    if not voices:
+        raise VoiceNotFoundError("Unsupported language")
+    return voices[0][0]
+
+
+def get_voice_tier(voice: str) -> Tuple[str, Optional[str]]:
+    """voice -> (speaker family, quality tier), eg. en_GB-alan-low -> (en_GB-alan, low)"""
+    voice = SHORTNAMES.get(voice) or voice
+    family, _, tier = voice.rpartition("-")
+    if tier in QUALITY_TIERS:
+        return family, tier
+    return voice, None
+
+
+@lru_cache(maxsize=256)
+def get_faster_voices(voice: str) -> Tuple[str, ...]:
+    """Voices of a faster quality tier than voice.
+
+    Tiers of the same speaker family come first, then other voices of the same language,
+    each group ordered from the nearest tier to the fastest one."""
+    voice = SHORTNAMES.get(voice) or voice
+    family, tier = get_voice_tier(voice)
+    if tier is None:
+        return ()
+    rank = QUALITY_TIERS.index(tier)
+    lang_code = voice.split("-")[0]
+    same_family, same_lang = [], []
+    for name in SHORTNAMES.values():
+        name_family, name_tier = get_voice_tier(name)
+        if name_tier is None or QUALITY_TIERS.index(name_tier) >= rank:
+            continue
+        if name_family == family:
+            same_family.append(name)
+        elif name.split("-")[0] == lang_code:
+            same_lang.append(name)
+
+    def nearest_first(name):
+        return -QUALITY_TIERS.index(get_voice_tier(name)[1])
+
+    return tuple(sorted(same_family, key=nearest_first) + sorted(same_lang, key=nearest_first))
+
+
+# pre-build the resolution index for every catalog language
+for _lang in list(LANG2VOICES):
+    _resolve_lang_voices(_lang)
 
 
 def add_local_model(voice: str, model_path: str, model_cfg: str, lang: str):
@@ -215,3 +294,4 @@ def add_local_model(voice: str, model_path: str, model_cfg: str, lang: str):
 
     LOCALMODELS[voice] = [model_path, model_cfg]
     LANG2VOICES[lang].append(voice)
+    _invalidate_lang_index()
@@ -51,6 +51,9 @@ def required(requirements_file):
 
 PLUGIN_ENTRY_POINT = 'ovos-tts-plugin-piper = ovos_tts_plugin_piper:PiperTTSPlugin'
 SAMPLE_CONFIGS = 'ovos-tts-plugin-piper.config = ovos_tts_plugin_piper:PiperTTSPluginConfig'
+SERVER_ENTRY_POINT = 'ovos-tts-piper-server = ovos_tts_plugin_piper.server:main'
+BULK_ENTRY_POINT = 'ovos-tts-piper-bulk = ovos_tts_plugin_piper.bulk:main'
+ROUTER_ENTRY_POINT = 'ovos-tts-piper-router = ovos_tts_plugin_piper.cluster:main'
 
 setup(
     name='ovos_tts_plugin_piper',
@@ -88,5 +91,6 @@ setup(
     ],
     keywords='mycroft plugin tts OVOS OpenVoiceOS',
     entry_points={'mycroft.plugin.tts': PLUGIN_ENTRY_POINT,
-                  'mycroft.plugin.tts.config': SAMPLE_CONFIGS}
+                  'mycroft.plugin.tts.config': SAMPLE_CONFIGS,
+                  'console_scripts': [SERVER_ENTRY_POINT, BULK_ENTRY_POINT, ROUTER_ENTRY_POINT]}
 )